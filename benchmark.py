@@ -0,0 +1,693 @@
+"""Broker benchmarks."""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import selectors
+import signal
+import socket
+import statistics
+import tempfile
+import tracemalloc
+import xml.etree.ElementTree as ET
+from collections import deque
+import sys
+import threading
+import time
+
+from src.broker import Broker
+from src.capture import read_capture
+from src.clients import Consumer
+from src.middleware import AsyncJSONQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from src.protocol import FrameReader, Protocol
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the broker prints and the client logs while measuring."""
+    logging.disable(logging.INFO)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+    logging.disable(logging.NOTSET)
+
+
+def _start_broker(**kwargs) -> Broker:
+    """Run a broker on a free port in a background thread."""
+    kwargs.setdefault("port", 0)
+    broker = Broker(**kwargs)
+    threading.Thread(target=broker.run, daemon=True).start()
+    return broker
+
+
+def _run_broker(kwargs):
+    """Target of the broker process, in its own process group (with the workers of its encoding pool)."""
+    os.setpgrp()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        Broker(**kwargs).run()
+
+
+def _spawn_broker(**kwargs):
+    """Run a broker in its own process (so it does not share the GIL with the clients).
+
+    Returns the process and the port it listens on."""
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        kwargs["port"] = probe.getsockname()[1]
+    # a broker with a process pool has children of its own, which daemon processes cannot have
+    process = multiprocessing.Process(target=_run_broker, args=(kwargs,), daemon=not kwargs.get("encode_workers") or kwargs.get("executor") == "thread")
+    process.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", kwargs["port"])).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, kwargs["port"]
+
+
+def _latencies(samples):
+    """Median and 99th percentile of a list of seconds, in microseconds."""
+    samples = sorted(samples)
+    return (f"{statistics.median(samples) * 1e6:.0f}us",
+            f"{samples[int(len(samples) * 0.99) - 1] * 1e6:.0f}us")
+
+
+def _round_trips(producer, consumer, messages, value):
+    """Latency of publishing and receiving back one message at a time, then throughput of a burst."""
+    samples = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        producer.push(value)
+        consumer.pull()
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    sender = threading.Thread(target=lambda: [producer.push(value) for _ in range(messages)])
+    sender.start()
+    for _ in range(messages):
+        consumer.pull()
+    sender.join()
+    return samples, messages / (time.perf_counter() - start)
+
+
+def _rss_kib(pid) -> int:
+    """Resident set size of a process (Linux)."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _report(name, **values):
+    """Print one result line (the real stdout, the broker prints are silenced)."""
+    print(f"{name:<24}" + "  ".join(f"{key}={value}" for key, value in values.items()),
+          file=sys.__stdout__, flush=True)
+
+
+def bench_async(args):
+    """Fan-out to many subscriptions: threaded Consumer vs one asyncio loop."""
+    broker = _start_broker()
+    topic = "/bench/async"
+    total = args.subscriptions * args.messages
+
+    # threaded: one Consumer (and one thread) per subscription
+    threads_before = threading.active_count()
+    start = time.perf_counter()
+    consumers = [
+        Consumer(topic, functools.partial(JSONQueue, port=broker._port))
+        for _ in range(args.subscriptions)
+    ]
+    workers = [
+        threading.Thread(target=consumer.run, args=(args.messages,), daemon=True)
+        for consumer in consumers
+    ]
+    for worker in workers:
+        worker.start()
+    setup = time.perf_counter() - start
+    time.sleep(0.5)  # let the broker register every subscription
+
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER, port=broker._port)
+    threads = threading.active_count() - threads_before
+    start = time.perf_counter()
+    for value in range(args.messages):
+        producer.push(value)
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    _report("threaded Consumer", subscriptions=args.subscriptions, threads=threads,
+            setup=f"{setup:.3f}s", delivery=f"{elapsed:.3f}s", rate=f"{total / elapsed:.0f} msg/s")
+
+    # asyncio: every subscription on the same event loop
+    async def run_async():
+        start = time.perf_counter()
+        queues = await asyncio.gather(*[
+            AsyncJSONQueue.connect(topic + "/aio", port=broker._port)
+            for _ in range(args.subscriptions)
+        ])
+        setup = time.perf_counter() - start
+        await asyncio.sleep(0.5)
+
+        async def consume(queue):
+            count = 0
+            while count < args.messages:
+                count += len(await queue.pull_many(args.messages - count))
+
+        producer = await AsyncJSONQueue.connect(topic + "/aio", MiddlewareType.PRODUCER, port=broker._port)
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(consume(queue)) for queue in queues]
+        for value in range(args.messages):
+            await producer.push(value)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        for queue in queues + [producer]:
+            await queue.close()
+        return setup, elapsed
+
+    threads_before = threading.active_count()
+    setup, elapsed = asyncio.run(run_async())
+    _report("asyncio AsyncJSONQueue", subscriptions=args.subscriptions,
+            threads=threading.active_count() - threads_before,
+            setup=f"{setup:.3f}s", delivery=f"{elapsed:.3f}s", rate=f"{total / elapsed:.0f} msg/s")
+    broker.canceled = True
+
+
+def bench_shm(args):
+    """Small messages through TCP loopback vs shared-memory rings."""
+    process, port = _spawn_broker()
+    value = "x" * args.size
+
+    for name, options in (("TCP loopback", {}), ("shared memory", {"shm": True})):
+        consumer = PickleQueue("/bench/shm", port=port, **options)
+        producer = PickleQueue("/bench/shm", MiddlewareType.PRODUCER, port=port, **options)
+        time.sleep(0.2)
+
+        samples, rate = _round_trips(producer, consumer, args.messages, value)
+        median, p99 = _latencies(samples)
+        _report(name, size=f"{args.size}B", median=median, p99=p99, rate=f"{rate:.0f} msg/s")
+
+        consumer.close()
+        producer.close()
+    process.terminate()
+
+
+def bench_unix(args):
+    """Round trips through loopback TCP vs the broker's unix socket."""
+    path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+    process, port = _spawn_broker(unix_path=path)
+    value = "x" * args.size
+
+    for name, host in (("TCP loopback", "localhost"), ("unix socket", "unix://" + path)):
+        consumer = PickleQueue("/bench/unix", host=host, port=port)
+        producer = PickleQueue("/bench/unix", MiddlewareType.PRODUCER, host=host, port=port)
+        time.sleep(0.2)
+
+        samples, rate = _round_trips(producer, consumer, args.messages, value)
+        median, p99 = _latencies(samples)
+        _report(name, size=f"{args.size}B", median=median, p99=p99, rate=f"{rate:.0f} msg/s")
+
+        consumer.close()
+        producer.close()
+    process.terminate()
+
+
+def bench_recv(args):
+    """Receive path: recv + bytes per frame vs recv_into a reusable buffer, then broker RSS under load."""
+    frame = Protocol.frame(Protocol.publish("/bench/recv", "x" * args.size), 2)
+
+    for name, receive in (
+        ("recv_msg (bytes)", lambda conn, reader: Protocol.recv_msg(conn)),
+        ("FrameReader", lambda conn, reader: reader.recv_msg()),
+    ):
+        sender, receiver = socket.socketpair()
+        writer = threading.Thread(target=lambda: [sender.sendall(frame) for _ in range(args.messages)])
+        reader = FrameReader(receiver)
+        writer.start()
+
+        tracemalloc.start()
+        peaks = []
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            receive(receiver, reader)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        elapsed = time.perf_counter() - start
+        tracemalloc.stop()
+
+        writer.join()
+        sender.close()
+        receiver.close()
+        _report(name, size=f"{args.size}B", per_message=f"{elapsed / args.messages * 1e6:.1f}us",
+                allocated=f"{statistics.mean(peaks):.0f}B/msg")
+
+    # sustained fan-out through a broker process
+    process, port = _spawn_broker()
+    consumers = [PickleQueue("/bench/recv", port=port) for _ in range(args.subscriptions)]
+    producer = PickleQueue("/bench/recv", MiddlewareType.PRODUCER, port=port)
+    value = "x" * args.size
+    time.sleep(0.2)
+    idle = _rss_kib(process.pid)
+
+    drains = [
+        threading.Thread(target=lambda c=consumer: [c.pull() for _ in range(args.messages)], daemon=True)
+        for consumer in consumers
+    ]
+    for drain in drains:
+        drain.start()
+    peak = idle
+    start = time.perf_counter()
+    for i in range(args.messages):
+        producer.push(value)
+        if i % 100 == 0:
+            peak = max(peak, _rss_kib(process.pid))
+    for drain in drains:
+        drain.join()
+    elapsed = time.perf_counter() - start
+    _report("broker under load", subscriptions=args.subscriptions, size=f"{args.size}B",
+            rate=f"{args.messages / elapsed:.0f} msg/s", rss_idle=f"{idle}KiB", rss_peak=f"{peak}KiB")
+    process.terminate()
+
+
+def _legacy_xml(topic, value):
+    """The previous XML codec: f-string encoding and ElementTree parsing, values as strings."""
+    data = f'<?xml version="1.0"?><data command="publish" topic="{topic}" value="{value}"></data>'.encode("utf-8")
+    root = ET.fromstring(data.decode("utf-8"))
+    return {node: root.get(node) for node in root.keys()}
+
+
+def bench_codecs(args):
+    """Encode + decode of one publish per codec."""
+    value = list(range(args.size // 4)) if args.size > 16 else 42
+    message = Protocol.publish("/bench/codecs", value)
+
+    def timed(function):
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            function()
+        return (time.perf_counter() - start) / args.messages
+
+    legacy = timed(lambda: _legacy_xml(message.topic, message.value))
+    _report("XML (f-string + ET)", per_message=f"{legacy * 1e6:.1f}us", typed=False)
+    for name, code in (("XML (template)", 1), ("JSON", 0), ("pickle", 2)):
+        elapsed = timed(lambda: Protocol.decode(code, Protocol.encode(message, code)))
+        _report(name, per_message=f"{elapsed * 1e6:.1f}us", typed=True)
+
+
+def bench_buffers(args):
+    """Encode + decode of large bytes values: in-band pickle (copied into the stream) vs out-of-band buffers."""
+    value = bytes(args.size)
+    message = Protocol.publish("/bench/buffers", value)
+
+    def in_band():
+        return pickle.loads(pickle.dumps(message.pickleMsg(), protocol=4))
+
+    def out_of_band():
+        body, buffers = Protocol.encode_parts(message, 2)
+        return Protocol.decode(2, body, buffers)
+
+    for name, function in (("pickle in-band", in_band), ("pickle out-of-band", out_of_band)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            function()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _report(name, size=f"{args.size}B", per_message=f"{elapsed / args.messages * 1e6:.1f}us",
+                peak=f"{peak // 1024}KiB")
+
+
+def bench_dispatch(args):
+    """Broker read loop (receive, decode, dispatch, store) per codec: CPU and allocations per message."""
+    message = Protocol.publish("/bench/dispatch", "x" * args.size)
+    done = Protocol.frame(Protocol.publish("/bench/dispatch/done", 0), 2)
+    previous = pickle.dumps(message.pickleMsg())  # the dict frames pickle used before the records
+
+    for name, code, frame in (
+        ("JSON", 0, Protocol.frame(message, 0)),
+        ("XML", 1, Protocol.frame(message, 1)),
+        ("pickle (dict)", 2, Protocol.header(2, len(previous)) + previous),
+        ("pickle (record)", 2, Protocol.frame(message, 2)),
+    ):
+        broker = Broker(port=0)
+        sender, receiver = socket.socketpair()
+        broker.readers[receiver] = FrameReader(receiver)
+        broker.socketSerialization[receiver] = code
+
+        writer = threading.Thread(target=lambda: sender.sendall(frame * args.messages + done))
+        start = time.perf_counter()
+        writer.start()
+        while "/bench/dispatch/done" not in broker._topics:
+            broker.read(receiver, None)
+        elapsed = time.perf_counter() - start
+        writer.join()
+
+        body = memoryview(frame)[3:]
+        tracemalloc.start()
+        peaks = []
+        for _ in range(min(args.messages, 1000)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            decoded = Protocol.decode(code, body)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+        size = sys.getsizeof(decoded) + (sys.getsizeof(vars(decoded)) if hasattr(decoded, "__dict__") else 0)
+
+        sender.close()
+        receiver.close()
+        broker.socket.close()
+        _report(name, per_message=f"{elapsed / args.messages * 1e6:.1f}us",
+                decode_allocated=f"{statistics.mean(peaks):.0f}B/msg", message_object=f"{size}B")
+
+
+def bench_listing(args):
+    """Topic listing: one full list vs the pages of the sorted index, cold and cached."""
+    broker = Broker(port=0)
+    for i in range(args.topics): # filled directly, put_topic would also match every subscription
+        topic = f"/bench/listing/{i % 100}/{i}"
+        broker._topics[topic] = i
+        broker._index.add(topic)
+
+    start = time.perf_counter()
+    broker.list_topics()
+    _report("full list", topics=args.topics, elapsed=f"{(time.perf_counter() - start) * 1e3:.1f}ms")
+
+    def browse():
+        pages, cursor = 0, ""
+        while cursor is not None:
+            cursor = broker.list_page("/bench/listing/42/", cursor)[1]
+            pages += 1
+        return pages
+
+    for name in ("pages (cold)", "pages (cached)"):
+        start = time.perf_counter()
+        pages = browse()
+        elapsed = time.perf_counter() - start
+        _report(name, topics=args.topics, pages=pages, per_page=f"{elapsed / pages * 1e6:.1f}us")
+    broker.socket.close()
+
+
+def bench_store(args):
+    """High-cardinality topics: the stored values without a bound, within a byte budget, and with a ttl."""
+    value = "x" * args.size
+    for name, options in (("unbounded", {}), ("budget", {"max_bytes": 1 << 24}), ("ttl", {"ttl": 0.5})):
+        broker = Broker(port=0, **options)
+        start = time.perf_counter()
+        for i in range(args.topics):
+            broker.put_topic(f"/bench/store/{i}", value)
+            if i % 10000 == 0:
+                broker.expire()
+        elapsed = time.perf_counter() - start
+        stats = broker.memory_stats()
+        _report(name, topics=args.topics, per_put=f"{elapsed / args.topics * 1e6:.2f}us", kept=stats["topics"],
+                stored=f"{stats['bytes'] / 2 ** 20:.1f}MB", evicted=stats["evicted"], expired=stats["expired"],
+                subscriber_lists=len(broker.subscribers))
+        broker.socket.close()
+
+
+def bench_encoders(args):
+    """Latency of a small topic while large values fan out to mixed codecs, without and with the encoding pool."""
+    heavy = list(range(args.size // 8 if args.size > 16 else 8000)) # still fits a frame in every codec
+    for name, options in (("encode on loop", {}), ("thread pool", {"encode_workers": 4, "executor": "thread"}),
+                          ("process pool", {"encode_workers": 4, "executor": "process"})):
+        process, port = _spawn_broker(**options)
+        sinks = [queue("/bench/heavy", port=port) for queue in (JSONQueue, XMLQueue, PickleQueue)
+                 for _ in range(max(args.subscriptions // 100, 1))]
+        publisher = PickleQueue("/bench/heavy", MiddlewareType.PRODUCER, port=port)
+        consumer = PickleQueue("/bench/light", port=port)
+        producer = PickleQueue("/bench/light", MiddlewareType.PRODUCER, port=port)
+        time.sleep(0.2)
+        stop = threading.Event()
+
+        def drain(sink):
+            with contextlib.suppress(OSError):
+                while not stop.is_set():
+                    sink.pull()
+
+        def flood():
+            with contextlib.suppress(OSError):
+                while not stop.is_set():
+                    publisher.push(heavy)
+                    time.sleep(0.001)
+
+        for target, arguments in [(drain, (sink,)) for sink in sinks] + [(flood, ())]:
+            threading.Thread(target=target, args=arguments, daemon=True).start()
+        samples, _ = _round_trips(producer, consumer, args.messages, 1)
+        stop.set()
+        median, p99 = _latencies(samples)
+        _report(name, heavy=f"{len(heavy)} ints", sinks=len(sinks), light_median=median, light_p99=p99)
+        os.killpg(process.pid, signal.SIGKILL) # the broker and its pool
+        process.join()
+
+
+def _record_traffic(path, messages, size):
+    """Record a small mixed workload: subscribers of every codec on a few topics, one producer per topic."""
+    broker = _start_broker(record=path)
+    topics = [f"/bench/replay/{i}" for i in range(4)]
+    consumers = [queue(topics[i % len(topics)], port=broker._port)
+                 for i, queue in enumerate([JSONQueue, XMLQueue, PickleQueue] * len(topics))]
+    producers = [PickleQueue(topic, MiddlewareType.PRODUCER, port=broker._port) for topic in topics]
+    time.sleep(0.1)
+    for _ in range(messages):
+        for producer in producers:
+            producer.push("x" * size)
+        time.sleep(0.001)
+    for consumer in consumers:
+        for _ in range(messages):
+            consumer.pull()
+    for queue in consumers + producers:
+        queue.close()
+    time.sleep(0.2)
+    broker.canceled = True
+    time.sleep(0.3) # the loop stops and closes the capture
+
+
+def _replay_sockets(records, port, original):
+    """Replay a capture into a broker over TCP, one connection per captured connection, draining the deliveries.
+
+    A probe connection asks for a listing along the way: its round trips measure how far
+    behind the traffic the broker is. Returns the elapsed seconds and the probe latencies."""
+    selector = selectors.DefaultSelector()
+    probe = socket.create_connection(("localhost", port))
+    probe.sendall(Protocol.frame(Protocol.serialize(2), 0))
+    probe_reader = FrameReader(probe)
+    selector.register(probe, selectors.EVENT_READ)
+    ask = Protocol.frame(Protocol.ask_list(limit=1), 2)
+    every = max(len(records) // 200, 1)
+    asked, samples, conns = deque(), [], {}
+
+    def drain(timeout=0):
+        for key, _ in selector.select(timeout):
+            if key.fileobj is probe:
+                probe_reader.fill()
+                while probe_reader.next_frame() is not None:
+                    samples.append(time.perf_counter() - asked.popleft())
+            elif not key.fileobj.recv(1 << 16): # closed by the broker
+                selector.unregister(key.fileobj)
+
+    def send(sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[sock.send(view):]
+            except BlockingIOError: # the broker is busy sending us deliveries
+                drain(0.001)
+
+    start = time.perf_counter()
+    for n, (seconds, conn_id, data) in enumerate(records):
+        while original and start + seconds > time.perf_counter():
+            drain(start + seconds - time.perf_counter())
+        sock = conns.get(conn_id)
+        if data is None:
+            if sock is not None:
+                with contextlib.suppress(KeyError):
+                    selector.unregister(sock)
+                sock.close()
+                del conns[conn_id]
+            continue
+        if sock is None:
+            sock = conns[conn_id] = socket.create_connection(("localhost", port))
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+        send(sock, data)
+        if n % every == 0:
+            asked.append(time.perf_counter())
+            send(probe, ask)
+        drain()
+
+    asked.append(time.perf_counter()) # answered once the broker caught up with the replay
+    send(probe, ask)
+    while asked:
+        drain(1)
+    elapsed = time.perf_counter() - start
+    for sock in list(conns.values()) + [probe]:
+        sock.close()
+    return elapsed, samples
+
+
+def _replay_direct(records, original):
+    """Replay a capture straight into the read path of a broker in this process (no loop, no TCP).
+
+    Each captured connection is a socketpair; returns the elapsed seconds and the time to handle each record."""
+    broker = Broker(port=0)
+    outputs = selectors.DefaultSelector()
+    pairs, samples = {}, []
+
+    start = time.perf_counter()
+    for seconds, conn_id, data in records:
+        if original:
+            time.sleep(max(start + seconds - time.perf_counter(), 0))
+        if conn_id not in pairs:
+            conn, peer = pairs[conn_id] = socket.socketpair()
+            peer.setblocking(False)
+            broker.selector.register(conn, selectors.EVENT_READ, broker.read) # what accept() does
+            broker.readers[conn] = FrameReader(conn)
+            outputs.register(peer, selectors.EVENT_READ)
+        conn, peer = pairs[conn_id]
+
+        began = time.perf_counter()
+        if data is None:
+            outputs.unregister(peer)
+            peer.close()
+            broker.read(conn, selectors.EVENT_READ) # reads the end of the stream and disconnects
+            del pairs[conn_id]
+        else:
+            view = memoryview(data)
+            while view:
+                with contextlib.suppress(BlockingIOError):
+                    view = view[peer.send(view):]
+                broker.read(conn, selectors.EVENT_READ)
+        samples.append(time.perf_counter() - began)
+
+        for key, _ in outputs.select(0): # the deliveries
+            with contextlib.suppress(BlockingIOError):
+                key.fileobj.recv(1 << 16)
+    elapsed = time.perf_counter() - start
+
+    for conn, peer in pairs.values():
+        conn.close()
+        peer.close()
+    broker.socket.close()
+    return elapsed, samples
+
+
+def bench_replay(args):
+    """Replay a capture (Broker(record=path), or a mixed workload recorded now) over TCP and into the read path."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.capture
+        if path is None:
+            path = os.path.join(tmp, "traffic.cap")
+            _record_traffic(path, args.messages * 10, args.size)
+        records = list(read_capture(path))
+    frames = sum(data is not None for _, _, data in records)
+    size = sum(len(data) for _, _, data in records if data is not None)
+    original = args.pace == "original"
+
+    process, port = _spawn_broker()
+    elapsed, samples = _replay_sockets(records, port, original)
+    process.terminate()
+    median, p99 = _latencies(samples)
+    _report("replay (tcp)", pace=args.pace, frames=frames, elapsed=f"{elapsed:.2f}s",
+            throughput=f"{frames / elapsed:.0f}/s", bandwidth=f"{size / elapsed / 2 ** 20:.1f}MB/s",
+            probe_median=median, probe_p99=p99)
+
+    elapsed, samples = _replay_direct(records, original)
+    median, p99 = _latencies(samples)
+    _report("replay (read path)", pace=args.pace, frames=frames, elapsed=f"{elapsed:.2f}s",
+            throughput=f"{frames / elapsed:.0f}/s", bandwidth=f"{size / elapsed / 2 ** 20:.1f}MB/s",
+            handle_median=median, handle_p99=p99)
+
+
+def _raise_file_limit(needed):
+    """Raise the soft limit of open files (inherited by the broker process) up to the hard limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def bench_storm(args):
+    """Connection storm: every client connects at once, pipelines handshake + subscribe, waits for the stored value."""
+    limit = _raise_file_limit(2 * args.clients + 256)
+    clients = min(args.clients, (limit - 256) // 2)
+    process, port = _spawn_broker()
+    topic = "/bench/storm"
+    producer = PickleQueue(topic, MiddlewareType.PRODUCER, port=port)
+    producer.push("x" * args.size)
+    time.sleep(0.2)
+    opening = Protocol.frame(Protocol.serialize(2), 0) + Protocol.frame(Protocol.subscribe(topic), 2)
+
+    selector = selectors.DefaultSelector()
+    started = {}
+    start = time.perf_counter()
+    for _ in range(clients):
+        client = socket.socket()
+        client.setblocking(False)
+        client.connect_ex(("localhost", port))
+        started[client] = time.perf_counter()
+        selector.register(client, selectors.EVENT_WRITE)
+
+    served = []
+    while len(served) < clients:
+        for key, mask in selector.select(timeout=10):
+            client = key.fileobj
+            if mask & selectors.EVENT_WRITE:
+                client.sendall(opening)
+                selector.modify(client, selectors.EVENT_READ)
+            elif client.recv(65536):
+                served.append(time.perf_counter() - started[client])
+                selector.unregister(client)
+        if time.perf_counter() - start > 120:
+            break
+    elapsed = time.perf_counter() - start
+
+    for client in started:
+        client.close()
+    producer.close()
+    process.terminate()
+    median, p99 = _latencies(served)
+    _report("connection storm", clients=clients, served=len(served), all_served=f"{elapsed:.2f}s",
+            median=median, p99=p99)
+
+
+BENCHMARKS = {
+    "async": bench_async,
+    "shm": bench_shm,
+    "unix": bench_unix,
+    "recv": bench_recv,
+    "codecs": bench_codecs,
+    "buffers": bench_buffers,
+    "dispatch": bench_dispatch,
+    "listing": bench_listing,
+    "storm": bench_storm,
+    "encoders": bench_encoders,
+    "store": bench_store,
+    "replay": bench_replay,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()))
+    parser.add_argument("--subscriptions", help="number of subscriptions", type=int, default=500)
+    parser.add_argument("--messages", help="number of messages to publish", type=int, default=20)
+    parser.add_argument("--clients", help="number of clients connecting at once", type=int, default=10000)
+    parser.add_argument("--topics", help="number of topics in the broker", type=int, default=1000000)
+    parser.add_argument("--size", help="size of the published values, in bytes", type=int, default=16)
+    parser.add_argument("--capture", help="capture file to replay (default: record a mixed workload)", default=None)
+    parser.add_argument("--pace", help="replay at the captured pace or as fast as possible",
+                        choices=["max", "original"], default="max")
+    args = parser.parse_args()
+
+    with _quiet():
+        BENCHMARKS[args.benchmark](args)
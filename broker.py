@@ -1,7 +1,27 @@
 """Call broker."""
+import argparse
+import socket
 
 from src.broker import Broker
 
 if __name__ == "__main__":
-    broker = Broker()
-    broker.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address to listen on", default="localhost")
+    parser.add_argument("--port", help="TCP port to listen on", type=int, default=5000)
+    parser.add_argument("--unix", help="unix socket path to listen on as well", default=None)
+    parser.add_argument("--backlog", help="connections waiting to be accepted", type=int, default=socket.SOMAXCONN)
+    parser.add_argument("--encode-workers", help="workers encoding large publishes off the loop", type=int, default=0)
+    parser.add_argument("--executor", help="kind of encoding workers", choices=["thread", "process"], default="process")
+    parser.add_argument("--ttl", help="seconds a published value is kept (default: forever)", type=float, default=None)
+    parser.add_argument("--max-bytes", help="memory budget of the published values kept", type=int, default=None)
+    parser.add_argument("--record", help="capture file to record the received frames to", default=None)
+    args = parser.parse_args()
+
+    broker = Broker(args.host, args.port, unix_path=args.unix, backlog=args.backlog,
+                    encode_workers=args.encode_workers, executor=args.executor,
+                    ttl=args.ttl, max_bytes=args.max_bytes, record=args.record)
+    try:
+        broker.run()
+    finally:
+        if broker.recorder is not None: # a broker stopped with Ctrl+C keeps its capture
+            broker.recorder.close()
@@ -1,5 +1,6 @@
 """Example Consumer."""
 import argparse
+import functools
 
 from src.clients import Consumer
 from producer import q_generator, q_protocol
@@ -19,8 +20,12 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument("--host", help="broker address (or unix:///path)", default="localhost")
+    parser.add_argument("--port", help="broker TCP port", type=int, default=5000)
+    parser.add_argument("--group", help="consumer group to share the messages with", default=None)
     args = parser.parse_args()
+    queue_type = functools.partial(q_protocol[args.queue_type], host=args.host, port=args.port)
 
-    c = Consumer(args.topic, q_protocol[args.queue_type])
+    c = Consumer(args.topic, queue_type, group=args.group)
 
     c.run(int(args.length))
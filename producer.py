@@ -1,6 +1,7 @@
 """Example Producer."""
 
 import argparse
+import functools
 import time
 import random
 
@@ -103,10 +104,13 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument("--host", help="broker address (or unix:///path)", default="localhost")
+    parser.add_argument("--port", help="broker TCP port", type=int, default=5000)
     args = parser.parse_args()
+    queue_type = functools.partial(q_protocol[args.queue_type], host=args.host, port=args.port)
 
     p = Producer(
-        q_subtopics[args.topic], q_generator[args.topic], q_protocol[args.queue_type]
+        q_subtopics[args.topic], q_generator[args.topic], queue_type
     )
 
     p.run(int(args.length))
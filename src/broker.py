@@ -1,9 +1,21 @@
 """Message Broker"""
+import bisect
 import enum
+import json
+import math
+import os
+import sys
+import time
+import uuid
+import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, List, Any, Tuple
 import socket
 import selectors
-from .protocol import Protocol
+from .capture import Recorder
+from .protocol import BUFFER, DOORBELL, Protocol, FrameReader, connect, xml_escape
+from .shm import RingBuffer
 
 
 
@@ -15,95 +27,526 @@ class Serializer(enum.Enum):
     PICKLE = 2
 
 
+LIST_PAGE = 100 # topics per listing page, unless the client asks for another limit
+MAX_LIST_PAGE = 1000
+ACCEPT_PAUSE = 0.1 # seconds a listening socket is not watched after running out of file descriptors
+LIST_BYTES = 1 << 15 # a page stops short of its limit rather than growing past this (frames have a 2 byte length)
+
+
+class FlowControl:
+    """Credit state of a connection that asked for flow control."""
+
+    def __init__(self, max_pending):
+        self.credit = 0 # messages the client can still take
+        self.outstanding = 0 # messages delivered and not yet acknowledged
+        self.pending = deque(maxlen=max_pending) # (message, format, group or None) waiting for credit, oldest dropped first
+        self.dropped = 0
+
+
+class ShmLink:
+    """Shared-memory rings of a client on the same host; its socket only carries control messages."""
+
+    def __init__(self, upstream: RingBuffer, downstream: RingBuffer):
+        self.upstream = upstream # client -> broker
+        self.downstream = downstream # broker -> client
+        self.overflow = deque() # frames waiting for room in downstream
+        self.waiting = False # the next upstream publish was too big for the ring, it comes on the socket
+
+
+class PeerLink:
+    """State of a connection to another broker of the federation."""
+
+    def __init__(self, broker_id=None):
+        self.broker_id = broker_id
+        self.interests = {} # origin broker -> (version, topic prefixes it has subscribers for), as told by the peer
+        self.prefixes = [] # the prefixes behind the link still current, publishes matching them are forwarded
+        self.advertised = None # last interests we sent to the peer
+
+
+class TopicIndex:
+    """Sorted set of topics, kept in chunks so an insert only shifts one chunk (millions of topics)."""
+
+    CHUNK = 1000
+
+    def __init__(self):
+        self._chunks = [] # sorted lists, each holding the topics up to its last one
+        self._maxes = [] # last topic of each chunk
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def add(self, topic: str):
+        """Insert a topic that is not in the index yet."""
+        if not self._chunks:
+            self._chunks.append([topic])
+            self._maxes.append(topic)
+            return
+        i = min(bisect.bisect_left(self._maxes, topic), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        bisect.insort(chunk, topic)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * self.CHUNK:
+            self._chunks[i:i + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+            self._maxes[i:i + 1] = [chunk[self.CHUNK - 1], chunk[-1]]
+
+    def discard(self, topic: str):
+        """Remove a topic, if it is in the index."""
+        i = bisect.bisect_left(self._maxes, topic)
+        if i == len(self._chunks):
+            return
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, topic)
+        if j == len(chunk) or chunk[j] != topic:
+            return
+        del chunk[j]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def iter_from(self, start: str, inclusive=True):
+        """The topics from start on (after start if not inclusive), in order."""
+        find = bisect.bisect_left if inclusive else bisect.bisect_right
+        i = find(self._maxes, start)
+        if i == len(self._chunks):
+            return
+        j = find(self._chunks[i], start)
+        for n in range(i, len(self._chunks)):
+            chunk = self._chunks[n]
+            for k in range(j, len(chunk)):
+                yield chunk[k]
+            j = 0
+
+
+class TimingWheel:
+    """Hashed timing wheel: a deadline goes to the slot of its tick, a tick only looks at its own slot."""
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)] # key -> deadline (in ticks), keys of later rounds stay put
+        self.deadlines = {} # key -> deadline (in ticks)
+        self.current = 0 # ticks done since start
+        self.start = time.monotonic()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, delay: float):
+        """(Re)schedule key to expire delay seconds from now."""
+        self.cancel(key)
+        now = int((time.monotonic() - self.start) / self.tick)
+        at = max(now, self.current) + max(math.ceil(delay / self.tick), 1)
+        self.deadlines[key] = at
+        self.slots[at % len(self.slots)][key] = at
+
+    def cancel(self, key):
+        """Forget the deadline of key, if it has one."""
+        at = self.deadlines.pop(key, None)
+        if at is not None:
+            del self.slots[at % len(self.slots)][key]
+
+    def advance(self) -> list:
+        """Do the ticks elapsed since the last call, returning the keys that expired."""
+        target = int((time.monotonic() - self.start) / self.tick)
+        expired = []
+        # after a long pause every slot is looked at once, not once per missed tick
+        for current in range(self.current + 1, self.current + 1 + min(target - self.current, len(self.slots))):
+            slot = self.slots[current % len(self.slots)]
+            due = [key for key, at in slot.items() if at <= target]
+            for key in due:
+                del slot[key]
+                del self.deadlines[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+
+def partition(key, members: int) -> int:
+    """Stable partition of a key (the same in every process and run, unlike hash())."""
+    if not isinstance(key, (bytes, bytearray)):
+        key = str(key).encode('utf-8') # str() so 7 and "7" (as XML sends it) land together
+    return zlib.crc32(key) % members
+
+
+class ConsumerGroup:
+    """Subscribers of a topic sharing its messages: each message goes to one member."""
+
+    def __init__(self, selection="round-robin"):
+        self.members = [] # [(client, serialization),...]
+        self.selection = selection # "round-robin" or "least-outstanding"
+        self._next = 0
+
+    def pick(self, key, flow) -> Tuple[socket.socket, Serializer]:
+        """Choose the member for a message: by partition of its key, else by the selection policy.
+
+        flow are the FlowControl of the connections, for "least-outstanding"."""
+        if not self.members:
+            return None
+        if key is not None:
+            return self.members[partition(key, len(self.members))]
+
+        self._next = (self._next + 1) % len(self.members)
+        if self.selection != "least-outstanding":
+            return self.members[self._next]
+
+        def load(member):
+            control = flow.get(member[0])
+            return 0 if control is None else control.outstanding + len(control.pending)
+
+        # ties go round-robin, starting from the next member
+        return min(self.members[self._next:] + self.members[:self._next], key=load)
+
+
+def value_size(value) -> int:
+    """Bytes a stored value holds: sys.getsizeof only counts a container, not what it contains."""
+    size = sys.getsizeof(value)
+    if type(value) is list or type(value) is tuple:
+        size += sum(value_size(item) for item in value)
+    elif type(value) is dict:
+        size += sum(value_size(key) + value_size(item) for key, item in value.items())
+    return size
+
+
+def listed_size(topic: str) -> int:
+    """Bytes a topic takes in a listing frame, in the largest codec: XML escapes the JSON text,
+    where non-ASCII characters are \\uXXXX escapes (not the length of the str)."""
+    return len(xml_escape(json.dumps(topic))) + 2 # separator
+
+
+def encode_publish(topic, value, code) -> list:
+    """Frame parts of a publish, encoded by a worker of the encoding pool (a module function so processes can run it)."""
+    return [Protocol.frame(Protocol.publish(topic, value), code)]
+
+
+def aggregate_topics(topics) -> List[str]:
+    """Drop the topics already covered by a shorter one (a subscriber of /a also receives /a/b)."""
+    kept = []
+    for topic in sorted(set(topics), key=len):
+        if not any(prefix in topic for prefix in kept):
+            kept.append(topic)
+    return sorted(kept)
+
+
 class Broker:
     """Implementation of a PubSub Message Broker."""
 
-    def __init__(self):
-        """Initialize broker."""
+    def __init__(self, host="localhost", port=5000, max_pending=1000, peers=(), broker_id=None, unix_path=None,
+                 backlog=socket.SOMAXCONN, encode_workers=0, executor="process", encode_min=1 << 14,
+                 group_selection="round-robin", ttl=None, ttls=None, max_bytes=None, record=None):
+        """Initialize broker.
+
+        With record=path every frame received is written to that capture file (see
+        src.capture), to replay the traffic later (python benchmark.py replay).
+        ttl is how many seconds a stored value lives (None: forever), ttls overrides it for
+        topics ({topic: seconds}, with the subscription rule: the longest topic contained wins).
+        With max_bytes the stored values are kept within that budget, evicting the least
+        recently used values of topics nobody subscribes to (see memory_stats()).
+        group_selection is how consumer groups pick the member for a message without a key:
+        "round-robin" or "least-outstanding" (fewest messages not acknowledged, for clients with credit).
+        With encode_workers=N, publishes of values from encode_min bytes (sys.getsizeof) are
+        encoded off the loop, once per serialization of their subscribers, by a pool of N
+        workers: executor "process", or "thread" (only gains with codecs that release the GIL,
+        none of JSON, XML and pickle does). A process pool leaves the pickle frames to the loop:
+        sending the value to a worker pickles it already. The publishes of a topic are still
+        delivered in order.
+        backlog is the length of the queue of connections waiting to be accepted.
+        unix_path is a unix socket path to listen on as well, for clients on the same host.
+        peers is a list of (host, port) of other brokers to federate with."""
         self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
+        self.recorder = Recorder(record) if record is not None else None
+        self._host = host
+        self._port = port
         self._topics = {} # topic -> value
+        self._candidates = OrderedDict() # topics nobody subscribes to (with max_bytes), least recently used first
+        self._sizes = {} # topic -> bytes accounted for its value
+        self.memory = 0 # bytes of all the stored values (shallow sizes)
+        self.max_bytes = max_bytes
+        self.default_ttl = ttl
+        self.ttls = dict(ttls or {})
+        self._wheel = TimingWheel()
+        self.evicted = 0 # values dropped to stay within max_bytes
+        self.expired = 0 # values dropped when their ttl ran out
+        self._index = TopicIndex() # sorted topics, for the paginated listings
+        self._listings = {} # (prefix, cursor, limit) -> listing page, cleared when a topic is added
         self.subscribers = {} # topic -> [(client, serialization),...]
+        self.groups = {} # topic -> {group name: ConsumerGroup}
+        self.group_selection = group_selection
         self.socketSerialization = {} # socket -> Serialization (JSON, XML, PICKLE)
+        self.readers = {} # socket -> FrameReader, the reusable receive buffer of the connection
+        self.flow = {} # socket -> FlowControl, only for clients that granted credit
+        self.max_pending = max_pending
+        self.broker_id = broker_id or uuid.uuid4().hex[:8]
+        self.peers = {} # socket -> PeerLink
+        self.rings = {} # socket -> ShmLink, for clients using shared memory
+        self._seq = 0 # sequence number of the publishes originated here
+        self.origins = {} # broker id -> (version, topic prefixes, link it was learned from, None for ours)
+        self._version = time.time_ns() # of our prefixes: from the clock, so a restart supersedes what we told before
+        self._seen = OrderedDict() # (origin, seq) of the last forwarded publishes, to drop duplicates
+        self._deliveries = {} # topic -> deque of (message, subscribers, frames) waiting for the encoding pool
+
+        self.encode_min = encode_min
+        self.encoder = None
+        # serializations encoded on the loop even with a pool (at delivery, see send)
+        self._on_loop = {Serializer.PICKLE.value} if executor == "process" else set()
+        if encode_workers:
+            pool = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+            self.encoder = pool(encode_workers)
+            # the workers ring the loop through this pair when an encoding is done
+            self._wakeup, self._wakeup_writer = socket.socketpair()
+            self._wakeup.setblocking(False)
+            self._wakeup_writer.setblocking(False)
         
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.selector = selectors.DefaultSelector()
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self._host, self._port))
-        self.socket.listen(100)
+        self._port = self.socket.getsockname()[1] # port=0 lets the OS pick a free port
+        self.socket.listen(backlog)
+        self.socket.setblocking(False) # accept() takes connections until none is left
         self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        if self.encoder is not None:
+            self.selector.register(self._wakeup, selectors.EVENT_READ, self.finish_encodes)
+
+        self.unix_path = unix_path
+        self.unix_socket = None
+        self._paused = [] # listening sockets not watched until _resume_at (out of file descriptors)
+        self._resume_at = 0
+        if unix_path is not None:
+            if os.path.exists(unix_path): # left behind by a previous run
+                os.unlink(unix_path)
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_socket.bind(unix_path)
+            self.unix_socket.listen(backlog)
+            self.unix_socket.setblocking(False)
+            self.selector.register(self.unix_socket, selectors.EVENT_READ, self.accept)
 
         print("BROKER initializaing...")
 
+        for peer in peers:
+            self.connect_peer(*peer)
+
         
     def accept(self, sock, mask):
-        conn, addr = sock.accept()                                  
-        print('accepted', conn, 'from', addr)
-        # conn.setblocking(False)
-        self.selector.register(conn, selectors.EVENT_READ, self.read)
+        """Take every connection waiting on a listening socket; each starts in the handshake state."""
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError: # no more connections waiting
+                return
+            except OSError as err: # out of file descriptors, the rest wait in the backlog
+                # the socket stays readable: stop watching it for a while instead of spinning on it
+                print('accept failed:', err)
+                self.selector.unregister(sock)
+                self._paused.append(sock)
+                self._resume_at = time.monotonic() + ACCEPT_PAUSE
+                return
+            print('accepted', conn, 'from', addr)
+            self.selector.register(conn, selectors.EVENT_READ, self.read)
+            self.readers[conn] = FrameReader(conn)
 
-        message = Protocol.recv_msg(conn)
+    def resume_accepting(self):
+        """Watch again the listening sockets paused by accept()."""
+        for sock in self._paused:
+            self.selector.register(sock, selectors.EVENT_READ, self.accept)
+        self._paused.clear()
+
+    def register(self, conn, message):
+        """Handshake: the first message of a connection announces its serialization."""
+        if message is None or message.command != 'type':
+            raise ConnectionError("connection did not announce its serialization")
         code = message.code
         if type(code) == str: code = int(code)
 
-        if message:
-            print(conn, " is now registered")
-            if code == 0 or code == Serializer.JSON:
-                self.socketSerialization[conn] = Serializer.JSON
-            elif code == 1 or code == Serializer.XML:
-                self.socketSerialization[conn] = Serializer.XML
-            elif code == 2 or code == Serializer.PICKLE:
-                self.socketSerialization[conn] = Serializer.PICKLE
-
+        print(conn, " is now registered")
+        if code == 0 or code == Serializer.JSON:
+            self.socketSerialization[conn] = Serializer.JSON
+        elif code == 1 or code == Serializer.XML:
+            self.socketSerialization[conn] = Serializer.XML
+        elif code == 2 or code == Serializer.PICKLE:
+            self.socketSerialization[conn] = Serializer.PICKLE
+        else:
+            raise ConnectionError(f"unknown serialization {code}")
 
     def read(self,conn, mask):
-        """verify the serialization method for each conn and decode it, used for 'old' connections """
+        """verify the serialization method for each conn and decode it, used for 'old' connections
+
+        The handshake is the first frame of a connection; the client may send more frames
+        right behind it (without waiting), they are handled in the same pass."""
+        reader = self.readers[conn]
         try:
-            message = Protocol.recv_msg(conn)
+            reader.fill()
+            for code, body, frame, buffers in reader.frames():
+                if conn not in self.socketSerialization:
+                    message = Protocol.decode(code, body, buffers)
+                    self.record(conn, message, self.raw_parts(frame, buffers))
+                    self.register(conn, message)
+                elif body or code == DOORBELL:
+                    message, raw = Protocol.decode(code, body, buffers), self.raw_parts(frame, buffers)
+                    self.record(conn, message, raw)
+                    if message: # None for an unknown command, ignored
+                        self.handle(conn, message, raw)
+                        link = self.rings.get(conn)
+                        if link is not None and link.waiting and message.command == 'publish':
+                            link.waiting = False # the records behind it can go now
+                            self.drain(conn)
+
+        except ConnectionError:
+            self.disconnect(conn)
 
-            if message:
-                print('Message received: ', message)
-                msgCommand = message.command
+    def record(self, conn, message, parts):
+        """Write a frame received from conn to the capture, if recording.
 
+        The shared-memory setup and the doorbells are left out and the ring records are
+        captured as frames (see drain), so a replay sees shm clients as socket clients."""
+        if self.recorder is not None and (message is None or message.command not in ('shm', 'ring')):
+            self.recorder.write(conn, parts)
 
-                if msgCommand == 'subscribe': #SubMessage
-                    print(conn, " has subbed to ", message.topic)
-                    self.subscribe(message.topic,conn, self.socketSerialization[conn])
+    @staticmethod
+    def raw_parts(frame, buffers) -> list:
+        """The frames of a message as received: its out-of-band buffers, then the message frame."""
+        if not buffers:
+            return [frame]
+        parts = Protocol.buffer_parts(buffers)
+        parts.append(frame)
+        return parts
 
-                elif msgCommand == 'publish': #PubMessage
-                    print(conn, " published", message.topic, " --> ", message.value)
-                    self.put_topic(message.topic, message.value)
+    def handle(self, conn, message, raw=None):
+        """Process a message received from conn (raw are its frames as received, valid during the call)."""
+        print('Message received: ', message)
+        msgCommand = message.command
 
-                elif msgCommand == 'ask': #AskListMessage
-                    print("Sending list of topics to ", conn)
-                    Protocol.send_msg(conn, Protocol.list(self.list_topics()), self.socketSerialization[conn])
 
-                elif msgCommand == 'cancel': #CancelMessage
-                    print(conn, " has cancelled the subscription to ", message.topic)
-                    self.unsubscribe(message.topic,conn)
+        if msgCommand == 'subscribe': #SubMessage
+            print(conn, " has subbed to ", message.topic)
+            self.subscribe(message.topic,conn, self.socketSerialization[conn], message.group)
 
+        elif msgCommand == 'publish': #PubMessage
+            print(conn, " published", message.topic, " --> ", message.value)
+            if message.origin is None:
+                self.put_topic(message.topic, message.value, raw=raw, key=message.key)
+            elif self.first_seen(message.origin, message.seq):
+                self.put_topic(message.topic, message.value, message.origin, message.seq, conn, key=message.key)
 
-        except ConnectionError:
-            print(conn, 'disconnected')
-            for i in self.subscribers:
-                list_users = self.subscribers[i]
-                for f in list_users:
-                    if f[0] == conn:
-                        self.subscribers[i].remove(f)
-                        break
+        elif msgCommand == 'ask': #AskListMessage
+            print("Sending list of topics to ", conn)
+            limit = min(message.limit or LIST_PAGE, MAX_LIST_PAGE)
+            topics, cursor = self.list_page(message.prefix, message.cursor, limit)
+            Protocol.send_msg(conn, Protocol.list(topics, cursor), self.socketSerialization[conn].value)
+
+        elif msgCommand == 'cancel': #CancelMessage
+            print(conn, " has cancelled the subscription to ", message.topic)
+            self.unsubscribe(message.topic,conn)
+
+        elif msgCommand == 'credit': #CreditMessage
+            self.grant(conn, message.credit)
+
+        elif msgCommand == 'shm': #ShmMessage
+            rings = []
+            try:
+                for name in (message.upstream, message.downstream):
+                    rings.append(RingBuffer.attach(name))
+            except (OSError, ValueError) as err: # the client sends its data there now, it cannot go on
+                for ring in rings:
+                    ring.close()
+                raise ConnectionError(f"cannot attach the shared memory: {err}")
+            print(conn, " moved its data to shared memory")
+            self.rings[conn] = ShmLink(*rings)
+
+        elif msgCommand == 'ring': #DoorbellMessage
+            if conn in self.rings: # a stray doorbell of a client without rings is ignored
+                self.drain(conn)
+
+        elif msgCommand == 'peer': #PeerMessage
+            print(conn, " is a link to broker ", message.origin)
+            if conn not in self.peers: # the other broker connected to us, introduce ourselves back
+                self.peers[conn] = PeerLink()
+                Protocol.send_msg(conn, Protocol.peer(self.broker_id), Serializer.PICKLE.value)
+            self.peers[conn].broker_id = message.origin
+            self.advertise()
+
+        elif msgCommand == 'interest': #InterestMessage
+            if conn not in self.peers: # only links that introduced themselves as brokers
+                print(conn, " is not a broker link, interests ignored")
+                return
+            self.peers[conn].interests = {origin: (version, list(prefixes))
+                                          for origin, (version, prefixes) in message.topics.items()
+                                          if origin != self.broker_id} # ours, back from a loop
+            self.advertise()
 
-            self.selector.unregister(conn)
-            conn.close()
+    def disconnect(self, conn):
+        """Forget a client that closed its connection."""
+        print(conn, 'disconnected')
+        if self.recorder is not None:
+            self.recorder.closed(conn)
+        released = []
+        for i in list(self.subscribers):
+            list_users = self.subscribers[i]
+            for f in list_users:
+                if f[0] == conn:
+                    self.subscribers[i].remove(f)
+                    break
+            if not list_users:
+                del self.subscribers[i]
+                released.append(i)
+        left = self.leave_groups(conn)
+        released.extend(topic for topic, _ in left if topic not in self.groups)
+        self.release(released)
+        flow = self.flow.pop(conn, None)
+        if left and flow is not None: # the other members take over what it was still owed
+            for message, _, group in flow.pending: # not what it got as a plain subscriber
+                if any(group is gone for _, gone in left) and group.members:
+                    member = group.pick(message.key, self.flow)
+                    self.deliver(member[0], message, member[1], group=group)
+        self.readers.pop(conn, None)
+        self.socketSerialization.pop(conn, None)
+        link = self.rings.pop(conn, None)
+        if link is not None:
+            link.upstream.close()
+            link.downstream.close()
+
+        self.selector.unregister(conn)
+        conn.close()
+        self.peers.pop(conn, None)
+        if self.peers:
+            self.advertise()
 
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics containing values."""
-        list = []
-        for key in self._topics:
-            list.append(key)
-        return list
-    
-        # secalhar um send também de Pedido de Listagenm de topicos
+        return list(self._index)
+
+    def list_page(self, prefix="", cursor="", limit=LIST_PAGE) -> Tuple[List[str], str]:
+        """Returns the topics starting with prefix that come after cursor (at most limit), and the next cursor.
+
+        The next cursor is None on the last page. Pages come from the sorted index (only the
+        page is read) and are cached until the set of topics changes."""
+        key = (prefix, cursor, limit)
+        page = self._listings.get(key)
+        if page is not None:
+            return page
+
+        if cursor and cursor >= prefix:
+            candidates = self._index.iter_from(cursor, inclusive=False)
+        else:
+            candidates = self._index.iter_from(prefix)
+        topics, size, next_cursor = [], 0, None
+        for topic in candidates:
+            if not topic.startswith(prefix):
+                break
+            size += listed_size(topic)
+            if len(topics) == limit or (topics and size > LIST_BYTES):
+                next_cursor = topics[-1]
+                break
+            topics.append(topic)
+
+        if len(self._listings) >= 1024:
+            self._listings.clear()
+        page = self._listings[key] = (topics, next_cursor)
+        return page
 
     def get_topic(self, topic):
         """Returns the currently stored value in topic."""
@@ -111,28 +554,377 @@ class Broker:
         # ou seja se o topic estiver no dicionario tem algo publicado nele
 
         if topic in self._topics:
+            if topic in self._candidates:
+                self._candidates.move_to_end(topic)
             return self._topics[topic]
         return None
 
-    #store in topic the value. If the topic is a subtopic from another topic, this topic also receives the value 
-    def put_topic(self, topic, value):
-        """Store in topic the value."""
-        # topics are in the format --> /weather, /weather/temp, /weather/pressure...
+    def memory_stats(self) -> Dict[str, Any]:
+        """Memory accounting of the stored values and how many were evicted or expired."""
+        return {
+            "topics": len(self._topics),
+            "bytes": self.memory,
+            "max_bytes": self.max_bytes,
+            "subscribed_topics": len(self.subscribers),
+            "evictable": len(self._candidates),
+            "expiring": len(self._wheel),
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+    def ttl_for(self, topic):
+        """Seconds the values of topic live, None for forever."""
+        best = None
+        for rule in self.ttls:
+            if rule in topic and (best is None or len(rule) > len(best)):
+                best = rule
+        return self.default_ttl if best is None else self.ttls[best]
+
+    def store(self, topic, value, subscribed=False):
+        """Keep value as the last one of topic, accounting for its memory and ttl.
+
+        Values of topics nobody subscribes to are the candidates for eviction, in use order."""
+        if topic not in self._topics:
+            self._index.add(topic)
+            self._listings.clear()
         self._topics[topic] = value
+        size = sys.getsizeof(topic) + value_size(value)
+        self.memory += size - self._sizes.get(topic, 0)
+        self._sizes[topic] = size
+
+        ttl = self.ttl_for(topic)
+        if ttl is not None:
+            self._wheel.schedule(topic, ttl)
+        if self.max_bytes is not None:
+            if subscribed:
+                self._candidates.pop(topic, None)
+            else:
+                self._candidates[topic] = None
+                self._candidates.move_to_end(topic)
+            if self.memory > self.max_bytes:
+                self.evict(keep=topic)
+
+    def drop_topic(self, topic):
+        """Forget the stored value of topic."""
+        del self._topics[topic]
+        self.memory -= self._sizes.pop(topic)
+        self._candidates.pop(topic, None)
+        self._wheel.cancel(topic)
+        self._index.discard(topic)
+        self._listings.clear()
+
+    def subscribed(self, topic) -> bool:
+        """Whether any subscriber or consumer group receives topic."""
+        return topic in self.subscribers or any(t in topic for t in self.subscribers) \
+            or any(t in topic for t in self.groups)
+
+    def claim(self, rule):
+        """A subscription to rule was made: the values it receives are no longer candidates for eviction."""
+        if self.max_bytes is None:
+            return
+        for topic in [topic for topic in self._candidates if rule in topic]:
+            del self._candidates[topic]
+
+    def release(self, rules):
+        """Subscriptions to rules are gone: the values nobody receives now are candidates for eviction again."""
+        if self.max_bytes is None or not rules:
+            return
+        for topic in self._topics:
+            if topic not in self._candidates and any(rule in topic for rule in rules) and not self.subscribed(topic):
+                self._candidates[topic] = None
+
+    def evict(self, keep=None):
+        """Drop the least recently used values nobody subscribes to until the budget is met."""
+        while self.memory > self.max_bytes and self._candidates:
+            topic = next(iter(self._candidates))
+            if topic == keep:
+                if len(self._candidates) == 1:
+                    break
+                self._candidates.move_to_end(topic)
+                continue
+            self.drop_topic(topic)
+            self.evicted += 1
 
+    def expire(self):
+        """Drop the values whose ttl ran out (one tick of the timing wheel)."""
+        for topic in self._wheel.advance():
+            self.drop_topic(topic)
+            self.expired += 1
+
+    #store in topic the value. If the topic is a subtopic from another topic, this topic also receives the value 
+    def put_topic(self, topic, value, origin=None, seq=None, source=None, raw=None, key=None):
+        """Store in topic the value.
+
+        origin/seq identify publishes forwarded by other brokers, source is the peer link they came from.
+        Each consumer group of the topic gets it once, on the member chosen for key.
+        raw is the publish as received (frame parts), sent untouched to the subscribers with the same
+        serialization: out-of-band pickle buffers are forwarded without being pickled again."""
+        # topics are in the format --> /weather, /weather/temp, /weather/pressure...
         # create list for subs if it does not exist and if it is a subtopic add subs from supertopic
+        # (only when there are some: topics nobody subscribes to must not leave empty lists behind)
         if topic not in self.subscribers:
-            self.subscribers[topic] = []
+            inherited = []
             for t in self.subscribers:
                 if t in topic:
                     for sub in self.list_subscriptions(t):
-                        if sub not in self.list_subscriptions(topic):
-                            self.subscribers[topic].append(sub)
+                        if sub not in inherited:
+                            inherited.append(sub)
+            if inherited:
+                self.subscribers[topic] = inherited
             
         # send messages (publishes)
-        if topic in self.subscribers:
-            for sub in self.list_subscriptions(topic):
-                Protocol.send_msg(sub[0], Protocol.publish(topic, value), sub[1].value)
+        subs = self.list_subscriptions(topic)
+        if self.groups:
+            subs = subs + self.pick_members(topic, key)
+        self.store(topic, value, subscribed=bool(subs))
+        if subs:
+            message = Protocol.publish(topic, value, key=key)
+            frames = {} # serialization code -> frame parts, each encoded once
+            if raw is not None:
+                frames[raw[-1][0]] = raw
+            if topic in self._deliveries or (self.encoder is not None and subs and sys.getsizeof(value) >= self.encode_min):
+                self.encode_later(message, subs, frames)
+            else:
+                for sub in subs:
+                    self.deliver(sub[0], message, sub[1], frames, *sub[2:])
+
+        # forward to the other brokers, after the local delivery
+        if self.peers:
+            if origin is None:
+                self._seq += 1
+                origin, seq = self.broker_id, self._seq
+            self.forward(Protocol.publish(topic, value, origin, seq, key), source)
+
+    def encode_later(self, message, subs, frames):
+        """Queue a publish behind the ones of its topic still being encoded, encoding it in the pool if large."""
+        for code, parts in frames.items(): # forwarded frames are views of a receive buffer, reused by the next reads
+            frames[code] = [bytes(part) for part in parts]
+        if self.encoder is not None and sys.getsizeof(message.value) >= self.encode_min:
+            for code in {sub[1].value for sub in subs} - frames.keys() - self._on_loop:
+                future = frames[code] = self.encoder.submit(encode_publish, message.topic, message.value, code)
+                future.add_done_callback(self._encoded)
+        self._deliveries.setdefault(message.topic, deque()).append((message, list(subs), frames))
+
+    def _encoded(self, future):
+        """Done callback of the encodings (runs outside the loop): wake the loop up."""
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError): # a wakeup is already pending, or the broker stopped
+            pass
+
+    def finish_encodes(self, sock, mask):
+        """Deliver, in order, the queued publishes of each topic whose encodings are done."""
+        try:
+            sock.recv(4096)
+        except BlockingIOError:
+            pass
+        for topic in list(self._deliveries):
+            queue = self._deliveries[topic]
+            while queue:
+                message, subs, frames = queue[0]
+                if any(type(parts) is Future and not parts.done() for parts in frames.values()):
+                    break
+                queue.popleft()
+                if not queue: # before delivering: once the last one is received, nothing is pending
+                    del self._deliveries[topic]
+                for code, parts in frames.items():
+                    if type(parts) is Future:
+                        try:
+                            frames[code] = parts.result()
+                        except (TypeError, ValueError, OverflowError) as err: # no frame in that serialization
+                            print('cannot encode', message.command, 'as', Serializer(code).name, ':', err)
+                            frames[code] = []
+                for sub in subs:
+                    if sub[0] in self.readers: # still connected
+                        self.deliver(sub[0], message, sub[1], frames, *sub[2:])
+
+    def pick_members(self, topic, key=None) -> List[Tuple[socket.socket, Serializer, ConsumerGroup]]:
+        """The member chosen in each consumer group receiving topic (same rule as the subscribers),
+        as (client, serialization, group)."""
+        picked = []
+        for group_topic, groups in self.groups.items():
+            if group_topic in topic:
+                for group in groups.values():
+                    member = group.pick(key, self.flow)
+                    if member is not None:
+                        picked.append(member + (group,))
+        return picked
+
+    def leave_groups(self, address) -> List[Tuple[str, ConsumerGroup]]:
+        """Remove a client from every consumer group, returning the (topic, group) it was in."""
+        left = []
+        for topic, groups in list(self.groups.items()):
+            for name, group in list(groups.items()):
+                kept = [member for member in group.members if member[0] != address]
+                if len(kept) != len(group.members):
+                    group.members = kept
+                    left.append((topic, group))
+                if not group.members:
+                    del groups[name]
+            if not groups:
+                del self.groups[topic]
+        return left
+
+    def connect_peer(self, host, port):
+        """Open a link to another broker of the federation."""
+        conn = connect(host, port)
+        Protocol.send_msg(conn, Protocol.serialize(Serializer.PICKLE.value), 0)
+        Protocol.send_msg(conn, Protocol.peer(self.broker_id), Serializer.PICKLE.value)
+        self.socketSerialization[conn] = Serializer.PICKLE
+        self.readers[conn] = FrameReader(conn)
+        self.peers[conn] = PeerLink()
+        self.selector.register(conn, selectors.EVENT_READ, self.read)
+        self.advertise()
+
+    def first_seen(self, origin, seq) -> bool:
+        """Check a forwarded publish was not received before (through another path or a loop)."""
+        if origin == self.broker_id or (origin, seq) in self._seen:
+            return False
+        self._seen[(origin, seq)] = True
+        if len(self._seen) > 10000:
+            self._seen.popitem(last=False)
+        return True
+
+    def forward(self, message, source=None):
+        """Send a publish once to every peer link interested in its topic."""
+        for conn, peer in self.peers.items():
+            if conn is source or peer.broker_id == message.origin:
+                continue
+            if any(prefix in message.topic for prefix in peer.prefixes):
+                Protocol.send_msg(conn, message, Serializer.PICKLE.value)
+
+    def learn(self):
+        """Keep the newest prefixes of every other broker, from whichever link told them."""
+        origins = {self.broker_id: self.origins[self.broker_id]} if self.broker_id in self.origins else {}
+        for conn, peer in self.peers.items():
+            for origin, (version, prefixes) in peer.interests.items():
+                if origin not in origins or version > origins[origin][0]:
+                    origins[origin] = (version, prefixes, conn)
+        self.origins = origins
+
+    def advertise(self):
+        """Tell every peer link the topics we (or the brokers behind us) have subscribers for.
+
+        The prefixes are sent per broker they originate from, with a version bumped on every
+        change: an origin withdrawing its prefixes (an empty list) supersedes the older
+        versions still going around a loop of links, which are then ignored."""
+        self.learn()
+        local = aggregate_topics([topic for topic, subs in self.subscribers.items() if subs] + list(self.groups))
+        if local != self.origins.get(self.broker_id, (None, []))[1]:
+            self._version += 1
+            self.origins[self.broker_id] = (self._version, local, None)
+        for conn, peer in self.peers.items():
+            peer.prefixes = aggregate_topics(prefix for origin, (version, prefixes) in peer.interests.items()
+                                             if self.origins[origin][0] == version for prefix in prefixes)
+            # split horizon: never advertise back to a peer what it told us
+            interests = {origin: (version, prefixes) for origin, (version, prefixes, source) in self.origins.items()
+                         if source is not conn and origin != peer.broker_id}
+            if interests != peer.advertised:
+                peer.advertised = interests
+                Protocol.send_msg(conn, Protocol.interest(interests), Serializer.PICKLE.value)
+
+    def deliver(self, address: socket.socket, message, _format: Serializer, frames=None, group=None):
+        """Send a message to a client, holding it back while the client has no credit.
+
+        group is the consumer group the client gets it for (None as a plain subscriber)."""
+        flow = self.flow.get(address)
+        if flow is None: # no flow control, send right away
+            self.send(address, message, _format, frames)
+            return
+
+        if flow.credit > 0 and not flow.pending:
+            if self.send(address, message, _format, frames):
+                flow.credit -= 1
+                flow.outstanding += 1
+        else:
+            if len(flow.pending) == flow.pending.maxlen:
+                flow.dropped += 1
+            flow.pending.append((message, _format, group))
+
+    @staticmethod
+    def encode(message, _format: Serializer) -> list:
+        """Frame parts of a message, [] when it has no frame in that serialization.
+
+        The value of a publish comes from any producer: bytes from pickle cannot be sent as JSON,
+        or are too long for an XML frame once turned into text."""
+        try:
+            return Protocol.frame_parts(message, _format.value)
+        except (TypeError, ValueError, OverflowError) as err:
+            print('cannot encode', message.command, 'as', _format.name, ':', err)
+            return []
+
+    def send(self, address: socket.socket, message, _format: Serializer, frames=None) -> bool:
+        """Send a message to a client, through its shared-memory ring if it has one.
+
+        frames caches the encoded message (list of frame parts) per serialization, for fan-outs.
+        Returns False when the message could not be encoded for the client (it is skipped)."""
+        if frames is None:
+            parts = self.encode(message, _format)
+        else:
+            parts = frames.get(_format.value)
+            if parts is None:
+                parts = frames[_format.value] = self.encode(message, _format)
+        if not parts:
+            return False
+
+        link = self.rings.get(address)
+        if link is None:
+            if len(parts) == 1:
+                address.sendall(parts[0])
+            else:
+                Protocol.send_parts(address, parts)
+            return True
+
+        record = parts[0] if len(parts) == 1 else b''.join(parts)
+        if len(record) > link.downstream.capacity // 4: # too big for the ring, the client also reads the socket
+            Protocol.send_parts(address, parts)
+        elif link.overflow or not link.downstream.write(record):
+            link.overflow.append(bytes(record)) # the ring is full, retried by the run loop
+        elif link.downstream.need_wakeup():
+            Protocol.send_doorbell(address)
+        return True
+
+    def flush_rings(self):
+        """Move the frames that did not fit into the rings of shared-memory clients."""
+        for conn, link in self.rings.items():
+            written = False
+            while link.overflow and link.downstream.write(link.overflow[0]):
+                link.overflow.popleft()
+                written = True
+            if written and link.downstream.need_wakeup():
+                Protocol.send_doorbell(conn)
+
+    def drain(self, conn):
+        """Process every record of the upstream ring of a shared-memory client."""
+        link = self.rings[conn]
+        while not link.waiting:
+            frame = link.upstream.read()
+            while frame is not None:
+                if frame[0] == DOORBELL: # the next publish was too big for the ring, read resumes once it is in
+                    link.waiting = True
+                    return
+                message, raw = Protocol.decode_record(frame), [frame] if frame[0] != BUFFER else None
+                self.record(conn, message, [frame])
+                if message:
+                    self.handle(conn, message, raw)
+                frame = link.upstream.read()
+            if link.upstream.sleep(): # nothing arrived meanwhile, wait for the next doorbell
+                return
+
+    def grant(self, address: socket.socket, credit: int):
+        """Add credit to a client (acknowledging delivered messages) and send what it now allows."""
+        flow = self.flow.get(address)
+        if flow is None:
+            flow = self.flow[address] = FlowControl(self.max_pending)
+        else:
+            flow.outstanding = max(flow.outstanding - credit, 0)
+        flow.credit += credit
+
+        while flow.credit > 0 and flow.pending:
+            message, _format, _ = flow.pending.popleft()
+            if self.send(address, message, _format):
+                flow.credit -= 1
+                flow.outstanding += 1
 
     def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
         """Provide list of subscribers to a given topic."""
@@ -140,11 +932,23 @@ class Broker:
             return self.subscribers[topic]
         return []
 
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
+    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None, group: str = None):
+        """Subscribe to topic by client in address.
+
+        With a group the client joins the consumer group instead (it does not get the stored value,
+        the group already had it)."""
         # Mensagem de broker -> cliente  é em xml ou pickle
         # Mensagem de produtor -> broker  é em json
 
+        if group is not None:
+            members = self.groups.setdefault(topic, {}).setdefault(group, ConsumerGroup(self.group_selection)).members
+            if (address, _format) not in members:
+                members.append((address, _format))
+            self.claim(topic)
+            if self.peers:
+                self.advertise()
+            return
+
         if topic not in self.subscribers:
             self.subscribers[topic] = []
             for t in self.subscribers:
@@ -153,19 +957,39 @@ class Broker:
                         if sub not in self.list_subscriptions(topic):
                             self.subscribers[topic].append(sub)
 
-        self.subscribers[topic].append((address, _format))
-        
+        # a client that re-subscribes (e.g. a shared transport restoring its subscriptions) must not be served twice
+        if (address, _format) not in self.subscribers[topic]:
+            self.subscribers[topic].append((address, _format))
+        self.claim(topic)
+
         # send last published topic
         if topic in self._topics:
-            Protocol.send_msg(address, Protocol.publish(topic, self._topics[topic]), _format.value) # sends the last message to the subscriber
+            self.deliver(address, Protocol.publish(topic, self.get_topic(topic)), _format) # sends the last message to the subscriber
         # has to be _format-value to send 0... instead of Seralizer.JSON... --> gives error in send_msg
 
+        if self.peers:
+            self.advertise()
+
     def unsubscribe(self, topic, address):
         """Unsubscribe to topic by client in address."""
 
         if topic in self.subscribers:
             for sub in self.subscribers[topic]: 
                 if sub[0] == address: self.subscribers[topic].remove(sub)
+            if not self.subscribers[topic]:
+                del self.subscribers[topic]
+
+        for name, group in list(self.groups.get(topic, {}).items()):
+            group.members = [member for member in group.members if member[0] != address]
+            if not group.members:
+                del self.groups[topic][name]
+        if topic in self.groups and not self.groups[topic]:
+            del self.groups[topic]
+        if topic not in self.subscribers and topic not in self.groups:
+            self.release([topic])
+
+        if self.peers:
+            self.advertise()
 
         # self.CancelSubMesssage(Message) ou algo assim
 
@@ -174,6 +998,31 @@ class Broker:
         """Run until canceled."""
 
         while not self.canceled:
-            for key, mask in self.selector.select():
+            # wake up regularly so that setting canceled stops the loop,
+            # and soon when a shared-memory client has frames waiting for room
+            overflow = any(link.overflow for link in self.rings.values())
+            for key, mask in self.selector.select(timeout=0.001 if overflow else self._wheel.tick):
                 callback = key.data
-                callback(key.fileobj, mask)
\ No newline at end of file
+                callback(key.fileobj, mask)
+            if self._wheel.deadlines:
+                self.expire()
+            if self._paused and time.monotonic() >= self._resume_at:
+                self.resume_accepting()
+            if overflow:
+                self.flush_rings()
+
+        if self.encoder is not None:
+            self.encoder.shutdown(wait=False, cancel_futures=True)
+            self.selector.unregister(self._wakeup)
+            self._wakeup.close()
+            self._wakeup_writer.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        self.resume_accepting()
+        if self.unix_socket is not None:
+            self.selector.unregister(self.unix_socket)
+            self.unix_socket.close()
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""Capture files of the traffic received by a broker, to replay it later."""
+import struct
+import time
+
+MAGIC = b"MBCAP\x01\r\n"
+# record header: seconds since the capture started, connection id, length of the bytes that follow
+_RECORD = struct.Struct("<dII")
+CLOSED = 0xFFFFFFFF # record length marking the connection was closed (no bytes follow)
+
+
+class Recorder:
+    """Writer of a capture: every frame received, as received, with when and on which connection.
+
+    Frames are written with their out-of-band buffers, so replaying the bytes of a
+    connection in order reproduces its stream. Writes go through a large file buffer,
+    nothing reaches the disk before it is full or the recorder is closed."""
+
+    def __init__(self, path, buffering=1 << 20):
+        self.file = open(path, "wb", buffering=buffering)
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.ids = {} # connection -> id, given in the order the connections are first seen
+        self._next = 0
+        self.records = 0
+
+    def conn_id(self, conn) -> int:
+        """The id of a connection in the capture."""
+        conn_id = self.ids.get(conn)
+        if conn_id is None:
+            conn_id = self.ids[conn] = self._next
+            self._next += 1
+        return conn_id
+
+    def write(self, conn, parts):
+        """Record the frame parts (bytes or memoryviews) received on conn."""
+        self.file.write(_RECORD.pack(time.monotonic() - self.start, self.conn_id(conn), sum(map(len, parts))))
+        for part in parts:
+            self.file.write(part)
+        self.records += 1
+
+    def closed(self, conn):
+        """Record that conn was closed (if anything was received on it)."""
+        conn_id = self.ids.pop(conn, None)
+        if conn_id is not None:
+            self.file.write(_RECORD.pack(time.monotonic() - self.start, conn_id, CLOSED))
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Yield the records of a capture: (seconds, connection id, bytes), bytes is None when the connection closed."""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = file.read(_RECORD.size)
+            if len(header) < _RECORD.size: # the end, or a capture cut short
+                return
+            seconds, conn_id, length = _RECORD.unpack(header)
+            if length == CLOSED:
+                yield seconds, conn_id, None
+                continue
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield seconds, conn_id, data
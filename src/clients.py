@@ -6,10 +6,15 @@ from src.middleware import PickleQueue, MiddlewareType
 class Consumer:
     """Consumer implementation"""
 
-    def __init__(self, topic, queue_type=PickleQueue):
+    def __init__(self, topic, queue_type=PickleQueue, prefetch=None, group=None):
         """Initialize Queue"""
         self.topic = topic
-        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER)
+        options = {} # only the ones set, queue_type may not take them
+        if prefetch:
+            options["prefetch"] = prefetch
+        if group:
+            options["group"] = group
+        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER, **options)
         self.logger = get_logger(f"Consumer {topic}")
         self.received = []
 
@@ -1,14 +1,19 @@
+import asyncio
 import socket
 import selectors
+import threading
+import time
 
 # from src.middleware import MiddlewareType
-from .protocol import Protocol
+from .protocol import BUFFER, DOORBELL, FrameReader, Protocol, UNIX_SCHEME, connect
+from .shm import RingBuffer
 
 """Middleware to communicate with PubSub Message Broker."""
+from collections import deque
 from collections.abc import Callable
 from enum import Enum
-from queue import LifoQueue, Empty # needed?
-from typing import Any
+from queue import SimpleQueue
+from typing import Any, List, Tuple
 
 
 class MiddlewareType(Enum):
@@ -18,32 +23,313 @@ class MiddlewareType(Enum):
     PRODUCER = 2
 
 
+class SharedConnection:
+    """Broker connection shared by several logical queues of the same process.
+
+    A reader thread demultiplexes the publishes received on the socket into the
+    inbox of every logical queue whose topic matches, and transparently
+    reconnects (restoring all subscriptions) when the broker goes away."""
+
+    def __init__(self, host, port, code, backoff=0.1, max_backoff=5.0, send_timeout=5.0):
+        """Connect to the broker and start the reader thread.
+
+        While the broker is unreachable, send() waits at most send_timeout seconds
+        for the connection to come back before raising ConnectionError."""
+        self.host = host
+        self.port = port
+        self.code = code
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.send_timeout = send_timeout
+        self.users = 0 # logical queues currently using this connection
+        self._closed = threading.Event() # set without the lock, interrupts the reconnection backoff
+        self._connected = threading.Event() # cleared while the reader thread is reconnecting
+
+        self._lock = threading.RLock() # guards the socket writes and the subscription tables
+        self._subscriptions = {} # topic -> [inbox,...]
+        self._retained = {} # topic -> last (topic, value) received for exactly that topic
+
+        self.socket = connect(self.host, self.port)
+        self._open(self.socket)
+        self._connected.set()
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def _open(self, sock: socket.socket):
+        """Announce the serialization and restore the subscriptions (with the lock held)."""
+        # the broker takes the subscriptions right behind the handshake, send them all at once
+        opening = [Protocol.frame(Protocol.serialize(self.code), 0)]
+        for topic in self._subscriptions:
+            opening.append(Protocol.frame(Protocol.subscribe(topic), self.code))
+        sock.sendall(b"".join(opening))
+
+    def _reconnect(self, broken: socket.socket):
+        """Replace a broken socket, retrying with exponential backoff until connected or closed.
+
+        Only the reader thread reconnects, without the lock: the backoff sleeps do not hold it,
+        it is only taken to swap the new socket in."""
+        with self._lock:
+            if self.closed:
+                return
+            self._connected.clear()
+        try:
+            broken.shutdown(socket.SHUT_RDWR) # wakes up the reader thread blocked on it
+        except OSError:
+            pass
+        broken.close()
+
+        delay = self.backoff
+        while not self.closed:
+            try:
+                sock = connect(self.host, self.port)
+                with self._lock:
+                    if self.closed:
+                        sock.close()
+                        return
+                    self._open(sock)
+                    self.socket = sock
+                    self._connected.set()
+                return
+            except OSError:
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def send(self, msg):
+        """Send a message, waiting for the reader thread to reconnect if the socket is broken.
+
+        Raises ConnectionError when the connection is closed, or was not back within send_timeout."""
+        deadline = time.monotonic() + self.send_timeout
+        while True:
+            if not self._connected.wait(max(deadline - time.monotonic(), 0)) or self.closed:
+                raise ConnectionError(f"no connection to the broker at {self.host}:{self.port}")
+            with self._lock:
+                try:
+                    Protocol.send_msg(self.socket, msg, self.code)
+                    return
+                except OSError: # hand the break over to the reader thread
+                    self._connected.clear()
+                    try:
+                        self.socket.shutdown(socket.SHUT_RDWR) # wakes it up if blocked on the socket
+                    except OSError:
+                        pass
+
+    def _send_control(self, msg):
+        """Send a (un)subscription with the lock held, without waiting for a reconnection.
+
+        While disconnected it is not sent: the reconnection sends the subscription table."""
+        if not self._connected.is_set():
+            return
+        try:
+            Protocol.send_msg(self.socket, msg, self.code)
+        except OSError: # the reader thread notices the break and reconnects
+            pass
+
+    def subscribe(self, topic: str, inbox: SimpleQueue):
+        """Deliver the messages of topic into inbox."""
+        with self._lock:
+            if topic in self._subscriptions:
+                # already subscribed on the wire, so serve the stored value locally
+                self._subscriptions[topic].append(inbox)
+                if topic in self._retained:
+                    inbox.put(self._retained[topic])
+                return
+
+            self._subscriptions[topic] = [inbox]
+            self._send_control(Protocol.subscribe(topic))
+
+    def unsubscribe(self, topic: str, inbox: SimpleQueue):
+        """Stop delivering topic into inbox, cancelling on the wire once unused.
+
+        The cancel is not sent while another subscription of the connection covers topic
+        (/a covers /a/b): the broker would stop sending topic to the socket altogether."""
+        with self._lock:
+            inboxes = self._subscriptions.get(topic, [])
+            if inbox in inboxes:
+                inboxes.remove(inbox)
+            if topic in self._subscriptions and not inboxes:
+                del self._subscriptions[topic]
+                self._retained.pop(topic, None)
+                if not any(other in topic for other in self._subscriptions):
+                    self._send_control(Protocol.cancel(topic))
+
+    def _dispatch(self, message):
+        """Hand a received publish to every matching logical queue."""
+        if message.command != 'publish':
+            return
+        item = (message.topic, message.value)
+
+        with self._lock:
+            if message.topic in self._subscriptions:
+                self._retained[message.topic] = item
+            # same rule as the broker: a subscriber of /a also receives /a/b
+            for topic, inboxes in self._subscriptions.items():
+                if topic in message.topic:
+                    for inbox in inboxes:
+                        inbox.put(item)
+
+    def _read_loop(self):
+        """Receive messages until the connection is closed for good."""
+        reader = None
+        while not self.closed:
+            sock = self.socket
+            if not self._connected.is_set(): # a sender found the socket broken
+                self._reconnect(sock)
+                continue
+            if reader is None or reader.connection is not sock:
+                reader = FrameReader(sock)
+            try:
+                message = reader.recv_msg()
+            except (ConnectionError, OSError):
+                self._reconnect(sock)
+                continue
+            if message is not None:
+                self._dispatch(message)
+
+    def close(self):
+        """Close the connection and stop the reader thread (and a reconnection in progress)."""
+        self._closed.set()
+        self._connected.set() # senders waiting for a reconnection see it is closed
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class TransportManager:
+    """Process-wide pool of broker connections, keyed by (host, port, codec)."""
+
+    def __init__(self, pool_size=2):
+        """Create an empty pool."""
+        self.pool_size = pool_size
+        self._pools = {} # (host, port, code) -> [SharedConnection,...]
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port, code) -> SharedConnection:
+        """Get the least used connection, opening a new one while the pool is not full."""
+        with self._lock:
+            pool = self._pools.setdefault((host, port, code), [])
+            pool[:] = [conn for conn in pool if not conn.closed]
+
+            if len(pool) < self.pool_size and all(conn.users for conn in pool):
+                pool.append(SharedConnection(host, port, code))
+
+            conn = min(pool, key=lambda c: c.users)
+            conn.users += 1
+            return conn
+
+    def release(self, conn: SharedConnection):
+        """Give a connection back to the pool; it stays open for the next queue."""
+        with self._lock:
+            conn.users -= 1
+
+    def close_all(self):
+        """Close every pooled connection."""
+        with self._lock:
+            for pool in self._pools.values():
+                for conn in pool:
+                    conn.close()
+            self._pools.clear()
+
+
+transport_manager = TransportManager()
+
+
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        """Create Queue."""
+    code = 0 # if it is not defined send in JSON
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, host='localhost', port=5000, shared=False,
+                 prefetch=None, auto_ack=True, shm=False, shm_capacity=1 << 20, group=None):
+        """Create Queue.
+
+        With group=name the consumer joins that consumer group of the topic:
+        each message goes to only one member of the group (see push(key=...)).
+        host may also be a "unix:///path" address of the broker's unix socket.
+
+        With shared=True the queue is a logical queue on top of a pooled
+        connection from transport_manager instead of owning a socket.
+
+        With prefetch=N the broker sends at most N messages ahead of the
+        ones already processed. Credit is given back on the next pull, or
+        only when ack() is called if auto_ack is False.
+
+        With shm=True (clients on the same host as the broker) the messages
+        go through shared-memory rings and the socket only carries control
+        messages and doorbells."""
         self.topic = topic
         self._type = _type
-        self.code = 0 # if it is not defined send in JSON
-        self.host = 'localhost'
-        self.port = 5000
+        self.host = host
+        self.port = port
+        self.prefetch = prefetch
+        self.auto_ack = auto_ack
+        self.group = group
+        self._unacked = 0 # pulled messages whose credit was not given back yet
+        self._transport = None
+        self._rings = None # (upstream, downstream) with shm=True
+        self._backlog = deque() # publishes received while waiting for a listing
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if shared:
+            if prefetch or shm or group:
+                raise ValueError("prefetch, shm and group need a dedicated connection, not shared=True")
+            self._inbox = SimpleQueue()
+            self._transport = transport_manager.acquire(self.host, self.port, self.code)
+            if _type == MiddlewareType.CONSUMER:
+                self._transport.subscribe(self.topic, self._inbox)
+            return
+
+        self.socket = connect(self.host, self.port)
+        self._reader = FrameReader(self.socket)
         self.selector = selectors.DefaultSelector()
-        self.socket.connect((self.host, self.port))
         self.selector.register(self.socket, selectors.EVENT_READ, self.pull)
 
-        # if _type == MiddlewareType.CONSUMER:
-        #     Protocol.send_msg(self.socket, Protocol.subscribe(self.topic), self.code)
+        # the handshake and the first messages go out together, the broker does not answer the handshake
+        opening = [Protocol.frame(Protocol.serialize(self.code), 0)]
+
+        if prefetch: # before subscribing, so the stored value already counts
+            opening.append(Protocol.frame(Protocol.credit(prefetch), self.code))
 
+        if shm:
+            self._rings = (RingBuffer.create(shm_capacity), RingBuffer.create(shm_capacity))
+            opening.append(Protocol.frame(Protocol.shm(self._rings[0].name, self._rings[1].name), self.code))
 
-    def push(self, value):
-        """Sends data to broker."""
+        if _type == MiddlewareType.CONSUMER:
+            opening.append(Protocol.frame(Protocol.subscribe(self.topic, group), self.code))
+        self.socket.sendall(b"".join(opening))
+
+    def _send(self, message):
+        """Send a message through the pooled connection or the own socket."""
+        if self._transport is not None:
+            self._transport.send(message)
+        elif self._rings is not None and message.command == 'publish':
+            upstream = self._rings[0]
+            parts = Protocol.frame_parts(message, self.code)
+            too_big = sum(map(len, parts)) > upstream.capacity // 4
+            # a publish too big for the ring goes through the socket, announced in the ring
+            # by an empty doorbell record so that the broker takes it in order
+            frame = Protocol.header(DOORBELL, 0) if too_big else parts[0] if len(parts) == 1 else b''.join(parts)
+            while not upstream.write(frame): # the broker is behind, wait for room
+                time.sleep(0.0001)
+            if upstream.need_wakeup():
+                Protocol.send_doorbell(self.socket)
+            if too_big:
+                Protocol.send_parts(self.socket, parts)
+        else:
+            Protocol.send_msg(self.socket, message, self.code)
+
+    def push(self, value, key=None):
+        """Sends data to broker.
+
+        The messages with the same key go to the same member of each consumer group (in order)."""
         # mensagem de publicação para o broker
         # broker envia para todos os clientes que estão subscritos no topico
-        message = Protocol.publish(self.topic, value)
-        Protocol.send_msg(self.socket, message, self.code)
+        message = Protocol.publish(self.topic, value, key=key)
+        self._send(message)
 
     def pull(self) -> (str, Any):
         """Receives (topic, data) from broker.
@@ -51,54 +337,275 @@ class Queue:
         Should BLOCK the consumer!"""
         # o primeiro pull envia a ultima subscrição
         # os próximos bloqueiam até alguém publicar algo no topico
-        message = Protocol.recv_msg(self.socket)
-        if message is None: 
+        if self._transport is not None:
+            return self._inbox.get()
+
+        # the previous message was processed by now, give its credit back (in batches of half the window)
+        if self.prefetch and self.auto_ack and self._unacked >= max(self.prefetch // 2, 1):
+            self.ack(self._unacked)
+
+        if self._backlog:
+            message = self._backlog.popleft()
+        elif self._rings is not None:
+            message = self._pull_ring()
+        else:
+            message = self._reader.recv_msg()
+            while message is not None and message.command == 'list': # reply to a listing nobody waits for
+                message = self._reader.recv_msg()
+        if self.prefetch and self.auto_ack:
+            self._unacked += 1
+        if message is None:
             return None
         return (message.topic, message.value)
 
 
-    def list_topics(self, callback: Callable):
-        """Lists all topics available in the broker."""
-        # essencialmente pelos consumidores
-        # enviar mensagem ao broker a pedir a lista de topicos
-        # não retorna nada
-        message = Protocol.ask_list()
-        Protocol.send_msg(self.socket, message , self.code)
-        # callback(Protocol.recv_msg(self.socket))
+    def _pull_ring(self):
+        """Wait for the next publish in the downstream ring."""
+        downstream = self._rings[1]
+        while True:
+            frame = downstream.read()
+            if frame is not None:
+                return Protocol.decode_record(frame)
+            if downstream.sleep():
+                message = self._reader.recv_msg() # doorbell (or a control reply)
+                if message is not None and message.command == 'publish': # too big for the ring
+                    return message
+
+    def ack(self, n=1):
+        """Acknowledge n processed messages, allowing the broker to send n more."""
+        self._unacked = max(self._unacked - n, 0)
+        Protocol.send_msg(self.socket, Protocol.credit(n), self.code)
+
+    def list_topics(self, callback: Callable, prefix: str = "", limit: int = None):
+        """Lists the topics available in the broker (only the ones starting with prefix).
+
+        The broker sends them in sorted pages of at most limit topics; callback
+        is called with each page (a list of topics) as it arrives."""
+        if self._transport is not None: # replies would go to the reader thread, ask on a connection of our own
+            sock = connect(self.host, self.port)
+            try:
+                Protocol.send_msg(sock, Protocol.serialize(self.code), 0)
+                self._browse(sock, FrameReader(sock), callback, prefix, limit)
+            finally:
+                sock.close()
+        else:
+            self._browse(self.socket, self._reader, callback, prefix, limit)
+
+    def _browse(self, sock, reader: FrameReader, callback: Callable, prefix: str, limit):
+        """Ask for the listing page after page, keeping the publishes received meanwhile for pull()."""
+        cursor = ""
+        while cursor is not None:
+            Protocol.send_msg(sock, Protocol.ask_list(prefix, cursor, limit), self.code)
+            message = reader.recv_msg()
+            while message is None or message.command != 'list':
+                if message is not None and message.command == 'publish':
+                    self._backlog.append(message)
+                message = reader.recv_msg()
+            callback(message.topics)
+            cursor = message.cursor
 
     def cancel(self):
         """Cancel subscription."""
+        if self._transport is not None:
+            self._transport.unsubscribe(self.topic, self._inbox)
+            return
         message = Protocol.cancel(self.topic)
         Protocol.send_msg(self.socket, message, self.code)
 
+    def close(self):
+        """Release the pooled connection or close the own socket."""
+        if self._transport is not None:
+            if self._type == MiddlewareType.CONSUMER:
+                self._transport.unsubscribe(self.topic, self._inbox)
+            transport_manager.release(self._transport)
+            self._transport = None
+        else:
+            self.selector.close()
+            self.socket.close()
+            if self._rings is not None:
+                for ring in self._rings:
+                    ring.close()
+                    ring.unlink()
+                self._rings = None
+
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
-        self.code = 0
-        Protocol.send_msg(self.socket, Protocol.serialize(self.code), 0)
 
-        if _type == MiddlewareType.CONSUMER:
-            Protocol.send_msg(self.socket, Protocol.subscribe(topic), self.code)
+    code = 0
 
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
-        self.code = 1
-        Protocol.send_msg(self.socket, Protocol.serialize(self.code), 0)
 
-        if _type == MiddlewareType.CONSUMER:
-            Protocol.send_msg(self.socket, Protocol.subscribe(topic), self.code)
+    code = 1
+
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
-        self.code = 2
-        Protocol.send_msg(self.socket, Protocol.serialize(self.code), 0)
 
-        if _type == MiddlewareType.CONSUMER:
-            Protocol.send_msg(self.socket, Protocol.subscribe(topic), self.code)
\ No newline at end of file
+    code = 2
+
+
+class AsyncQueue:
+    """asyncio counterpart of Queue, speaking the same wire protocol.
+
+    Queues are created with ``await AsyncJSONQueue.connect(topic)`` (or used as
+    ``async with``) and consumed with ``async for topic, value in queue``, so
+    one event loop can serve many subscriptions without a thread per queue."""
+
+    code = 0 # if it is not defined send in JSON
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, host='localhost', port=5000, group=None):
+        """Create the queue; no I/O happens until open() is awaited.
+
+        group is the consumer group to join, as in Queue."""
+        self.topic = topic
+        self._type = _type
+        self.host = host
+        self.port = port
+        self.group = group
+        self._reader = None
+        self._writer = None
+        self._buffer = bytearray() # bytes read but not yet parsed into frames
+        self._frames = deque() # parsed frames not yet handed to the caller
+        self._buffers = [] # out-of-band buffers of the next message
+        self._backlog = deque() # (topic, data) received while waiting for a listing
+
+    @classmethod
+    async def connect(cls, topic, _type=MiddlewareType.CONSUMER, host='localhost', port=5000, group=None):
+        """Create and open a queue."""
+        queue = cls(topic, _type, host, port, group)
+        await queue.open()
+        return queue
+
+    async def open(self):
+        """Connect, announce the serialization and subscribe if consumer."""
+        if self.host.startswith(UNIX_SCHEME):
+            self._reader, self._writer = await asyncio.open_unix_connection(self.host[len(UNIX_SCHEME):])
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(Protocol.frame(Protocol.serialize(self.code), 0))
+        if self._type == MiddlewareType.CONSUMER:
+            self._writer.write(Protocol.frame(Protocol.subscribe(self.topic, self.group), self.code))
+        await self._writer.drain()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def push(self, value, key=None):
+        """Sends data to broker (key as in Queue.push)."""
+        self._writer.write(Protocol.frame(Protocol.publish(self.topic, value, key=key), self.code))
+        await self._writer.drain()
+
+    async def _fill(self):
+        """Read from the stream until at least one complete frame is parsed."""
+        while not self._frames:
+            chunk = await self._reader.read(65536)
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            self._buffer += chunk
+            frames, consumed = Protocol.split_frames(self._buffer)
+            del self._buffer[:consumed]
+            self._frames.extend(frames)
+
+    def _decode_next(self):
+        """Decode the next parsed frame (None for an out-of-band buffer, kept for its message)."""
+        code, body = self._frames.popleft()
+        if code == BUFFER:
+            self._buffers.append(body)
+            return None
+        message = Protocol.decode(code, body, self._buffers)
+        self._buffers = []
+        return message
+
+    def _next_message(self):
+        """Decode the next parsed message frame (None if it is not a publish)."""
+        message = self._decode_next()
+        if message is not None and message.command == 'publish':
+            return (message.topic, message.value)
+        return None
+
+    async def pull(self) -> (str, Any):
+        """Receives (topic, data) from broker, waiting for the next publish."""
+        while True:
+            if self._backlog:
+                return self._backlog.popleft()
+            await self._fill()
+            item = self._next_message()
+            if item is not None:
+                return item
+
+    async def pull_many(self, n: int) -> List[Tuple[str, Any]]:
+        """Receives a batch of at most n (topic, data).
+
+        Waits for the first publish only; the rest are the ones already read."""
+        batch = [await self.pull()]
+        while len(batch) < n and (self._backlog or self._frames):
+            item = self._backlog.popleft() if self._backlog else self._next_message()
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[str, Any]:
+        try:
+            return await self.pull()
+        except ConnectionError:
+            raise StopAsyncIteration
+
+    async def list_topics(self, prefix: str = "", cursor: str = "", limit: int = None) -> Tuple[List[str], str]:
+        """Asks the broker for a page of the topics starting with prefix, after cursor.
+
+        Returns the topics and the cursor of the next page (None on the last page).
+        The publishes received meanwhile are kept for pull()."""
+        self._writer.write(Protocol.frame(Protocol.ask_list(prefix, cursor, limit), self.code))
+        await self._writer.drain()
+        while True:
+            await self._fill()
+            message = self._decode_next()
+            if message is None:
+                continue
+            if message.command == 'list':
+                return message.topics, message.cursor
+            if message.command == 'publish':
+                self._backlog.append((message.topic, message.value))
+
+    async def cancel(self):
+        """Cancel subscription."""
+        self._writer.write(Protocol.frame(Protocol.cancel(self.topic), self.code))
+        await self._writer.drain()
+
+    async def close(self):
+        """Close the connection."""
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = None
+
+
+class AsyncJSONQueue(AsyncQueue):
+    """AsyncQueue implementation with JSON based serialization."""
+
+    code = 0
+
+
+class AsyncXMLQueue(AsyncQueue):
+    """AsyncQueue implementation with XML based serialization."""
+
+    code = 1
+
+
+class AsyncPickleQueue(AsyncQueue):
+    """AsyncQueue implementation with Pickle based serialization."""
+
+    code = 2
@@ -1,8 +1,11 @@
 import enum
-from socket import socket
+from socket import socket, create_connection, AF_UNIX, SOCK_STREAM
+import array
+import html
 import json
 import pickle
-import xml.etree.ElementTree as ET
+import re
+from typing import List, Tuple
 
 class Serializer(enum.Enum):
     """Possible message serializers."""
@@ -11,103 +14,386 @@ class Serializer(enum.Enum):
     XML = 1
     PICKLE = 2
 
+class Command(enum.IntEnum):
+    """Command codes heading the pickle records (JSON and XML carry the command name)."""
+
+    TYPE = 0
+    SUBSCRIBE = 1
+    PUBLISH = 2
+    ASK = 3
+    LIST = 4
+    CANCEL = 5
+    CREDIT = 6
+    PEER = 7
+    INTEREST = 8
+    SHM = 9
+
+UNIX_SCHEME = "unix://"
+
+def connect(host, port) -> socket:
+    """Opens a connection to a broker; host may be a "unix:///path/to/socket" address."""
+    if host.startswith(UNIX_SCHEME):
+        conn = socket(AF_UNIX, SOCK_STREAM)
+        conn.connect(host[len(UNIX_SCHEME):])
+        return conn
+    return create_connection((host, port))
+
+# XML: a single <data .../> element, one attribute per field. The value is
+# typed by the "type" attribute; list fields are JSON text.
+_XML_SPECIAL = re.compile(r'[&"<>\n\r\t]')
+_XML_ESCAPES = (("&", "&amp;"), ('"', "&quot;"), ("<", "&lt;"), (">", "&gt;"), ("\n", "&#10;"), ("\r", "&#13;"), ("\t", "&#9;"))
+_XML_ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+_XML_JSON_FIELDS = ("topics",)
+_XML_TYPES = {int: "int", float: "float", bool: "bool", str: "str", list: "list", tuple: "list", dict: "dict", type(None): "none"}
+_XML_PARSERS = {
+    "int": int,
+    "float": float,
+    "bool": lambda text: text == "True",
+    "str": str,
+    "list": json.loads,
+    "dict": json.loads,
+    "none": lambda text: None,
+}
+
+def xml_escape(text: str) -> str:
+    """Escapes text to be an XML attribute value."""
+    if _XML_SPECIAL.search(text) is None:
+        return text
+    for char, entity in _XML_ESCAPES:
+        text = text.replace(char, entity)
+    return text
+
+def xml_encode(fields: dict) -> str:
+    """Encodes the fields of a message as a <data .../> element."""
+    parts = ['<data']
+    for key, value in fields.items():
+        if key == "value":
+            kind = _XML_TYPES.get(type(value), "str")
+            if kind == "list" or kind == "dict":
+                try:
+                    text = json.dumps(value)
+                except TypeError: # not JSON serializable, send it as text like before
+                    kind, text = "str", str(value)
+            elif kind == "float":
+                text = repr(value)
+            else:
+                text = str(value)
+            parts.append(f' type="{kind}" value="{xml_escape(text)}"')
+        elif type(value) is str:
+            parts.append(f' {key}="{xml_escape(value)}"')
+        elif type(value) is list or type(value) is tuple:
+            parts.append(f' {key}="{xml_escape(json.dumps(value))}"')
+        else:
+            parts.append(f' {key}="{value}"')
+    parts.append('/>')
+    return ''.join(parts)
+
+def xml_decode(text: str) -> dict:
+    """Decodes a <data .../> element (also the old <?xml ...?><data ...></data> frames) into fields."""
+    start = text.find('<data')
+    if start < 0:
+        raise ProtocolBadFormat(text.encode('utf-8'))
+
+    message = {}
+    for key, raw in _XML_ATTRIBUTE.findall(text, start):
+        message[key] = html.unescape(raw) if '&' in raw else raw
+
+    kind = message.pop("type", None)
+    if "command" not in message: # old serialization messages used type="..." for the command
+        message["command"] = kind
+    elif kind is not None and "value" in message:
+        try:
+            message["value"] = _XML_PARSERS[kind](message["value"])
+        except (KeyError, ValueError):
+            raise ProtocolBadFormat(text.encode('utf-8'))
+
+    for key in _XML_JSON_FIELDS:
+        if key in message:
+            try:
+                message[key] = json.loads(message[key])
+            except ValueError: # old frames had the Python representation, keep the text
+                pass
+    return message
+
+BUFFER = 3 # frame code of an out-of-band pickle buffer, with a 4 byte length, sent before its message
+OUT_OF_BAND_MIN = 1 << 14 # bytes-like values from this size travel out of band
+
+def _rebuild_buffer(kind: str, buffer):
+    """Rebuilds a bytes/bytearray around a received out-of-band buffer.
+
+    A bytearray is the received buffer itself; bytes (immutable) costs one copy."""
+    if kind == "bytearray" and type(buffer) is bytearray:
+        return buffer
+    if kind == "bytearray":
+        return bytearray(buffer)
+    return bytes(buffer)
+
+def _rebuild_array(typecode: str, buffer):
+    """Rebuilds an array.array from a received out-of-band buffer."""
+    values = array.array(typecode)
+    values.frombytes(buffer)
+    return values
+
+class _OutOfBand:
+    """Stand-in for a large bytes/bytearray/array value, pickled as a PickleBuffer (sent out of band).
+
+    (pickle never asks reducer_override about exact bytes, so the values are swapped before dumping.)"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        if type(self.value) is array.array:
+            return _rebuild_array, (self.value.typecode, pickle.PickleBuffer(self.value))
+        return _rebuild_buffer, (type(self.value).__name__, pickle.PickleBuffer(self.value))
+
+def _is_large_buffer(value) -> bool:
+    kind = type(value)
+    if kind is bytes or kind is bytearray:
+        return len(value) >= OUT_OF_BAND_MIN
+    return kind is array.array and len(value) * value.itemsize >= OUT_OF_BAND_MIN
+
+def _out_of_band(value):
+    """The value with its large buffers (itself or the items of a list/tuple/dict) swapped by _OutOfBand, or None."""
+    if _is_large_buffer(value):
+        return _OutOfBand(value)
+    if type(value) is list or type(value) is tuple:
+        if any(_is_large_buffer(item) for item in value):
+            return type(value)(_OutOfBand(item) if _is_large_buffer(item) else item for item in value)
+    elif type(value) is dict:
+        if any(_is_large_buffer(item) for item in value.values()):
+            return {key: _OutOfBand(item) if _is_large_buffer(item) else item for key, item in value.items()}
+    return None
+
+DOORBELL = 255 # frame code of the empty frame that wakes up the reader of a shared-memory ring
+
 class Message:
-    """Message Type."""
+    """Message Type.
+
+    record() is the compact form used by pickle: a tuple of the command code and the fields."""
+    __slots__ = ("command",)
+    opcode = None
+
     def __init__(self, command):
         self.command = command
 
-    def __repr__(self): # this will be used in the subclasses to represent JSON messages
-        return '{"command":'
+    def __repr__(self): # for the logs only, the codecs encode pickleMsg()/record()
+        return json.dumps(self.pickleMsg(), default=repr)
+
+    def pickleMsg(self):
+        return {"command": self.command}
+
+    def xmlMsg(self):
+        return xml_encode(self.pickleMsg())
     
 class SerializationMessage(Message):
+    __slots__ = ("code",)
+    opcode = Command.TYPE.value
+
     def __init__(self, command, code):
         super().__init__(command)
         self.code = code
 
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}", "code": "{self.code}"' + '}'
-
     def pickleMsg(self):
         return {"command": self.command, "code": self.code}
+
+    def record(self):
+        return (self.opcode, self.code)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data type="{self.command}" code="{self.code}"></data>'
 
 class SubMessage(Message):
-    """Message to subscribe to a given topic."""
-    def __init__(self, command, topic):
+    """Message to subscribe to a given topic.
+
+    With a group, each message of the topic goes to only one member of the group."""
+    __slots__ = ("topic", "group")
+    opcode = Command.SUBSCRIBE.value
+
+    def __init__(self, command, topic, group=None):
         super().__init__(command)
         self.topic = topic
-    
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}", "topic": "{self.topic}"' + '}'
+        self.group = group
     
     def pickleMsg(self):
-        return {"command": self.command, "topic": self.topic}
+        if self.group is None:
+            return {"command": self.command, "topic": self.topic}
+        return {"command": self.command, "topic": self.topic, "group": self.group}
+
+    def record(self):
+        if self.group is None:
+            return (self.opcode, self.topic)
+        return (self.opcode, self.topic, self.group)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}"></data>'
     
 
 class PubMessage(Message):
-    """Message to publish a given topic."""
-    def __init__(self, command, topic, value):
+    """Message to publish a given topic.
+
+    origin and seq are only set on publishes forwarded between brokers.
+    key (optional) picks the member of a consumer group: the same key, the same member."""
+    __slots__ = ("topic", "value", "origin", "seq", "key")
+    opcode = Command.PUBLISH.value
+
+    def __init__(self, command, topic, value, origin=None, seq=None, key=None):
         super().__init__(command)
         self.topic = topic
         self.value = value
+        self.origin = origin
+        self.seq = seq
+        self.key = key
 
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}", "topic": "{self.topic}", "value": {self.value}' + '}'
-    
     def pickleMsg(self):
-        return {"command": self.command, "topic": self.topic, "value": self.value}
+        fields = {"command": self.command, "topic": self.topic, "value": self.value}
+        if self.origin is not None:
+            fields["origin"] = self.origin
+            fields["seq"] = self.seq
+        if self.key is not None:
+            fields["key"] = self.key
+        return fields
+
+    def record(self):
+        if self.origin is None and self.key is None:
+            return (self.opcode, self.topic, self.value)
+        return (self.opcode, self.topic, self.value, self.origin, self.seq, self.key)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}" value="{self.value}"></data>'
 
 class AskListMessage(Message):
-    def __init__(self, command):
-        super().__init__(command)
+    """Message asking for a page of the topics starting with prefix, after the topic cursor.
 
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}"' + '}'
+    limit is the most topics wanted in the page (None leaves it to the broker)."""
+    __slots__ = ("prefix", "cursor", "limit")
+    opcode = Command.ASK.value
+
+    def __init__(self, command, prefix="", cursor="", limit=None):
+        super().__init__(command)
+        self.prefix = prefix
+        self.cursor = cursor
+        self.limit = limit
 
     def pickleMsg(self):
-        return {"command": self.command}
+        if self.limit is None:
+            return {"command": self.command, "prefix": self.prefix, "cursor": self.cursor}
+        return {"command": self.command, "prefix": self.prefix, "cursor": self.cursor, "limit": self.limit}
+
+    def record(self):
+        return (self.opcode, self.prefix, self.cursor, self.limit)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data command="{self.command}"></data>'
 
 class ListMessage(Message):
-    """Message to list all topics."""
-    def __init__(self, command, topics):
+    """Message with a page of topics.
+
+    cursor is the cursor to ask for the next page with, None on the last page."""
+    __slots__ = ("topics", "cursor")
+    opcode = Command.LIST.value
+
+    def __init__(self, command, topics, cursor=None):
         super().__init__(command)
         self.topics = topics
+        self.cursor = cursor
 
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}", "topics": {self.topics}' + '}'
-    
     def pickleMsg(self):
-        return {"command": self.command, "topics": self.topics}
+        if self.cursor is None:
+            return {"command": self.command, "topics": self.topics}
+        return {"command": self.command, "topics": self.topics, "cursor": self.cursor}
+
+    def record(self):
+        if self.cursor is None:
+            return (self.opcode, self.topics)
+        return (self.opcode, self.topics, self.cursor)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data command="{self.command}" topics="{self.topics}"></data>'
     
 class CancelMessage(Message):
     """Message to cancel a given topic."""
+    __slots__ = ("topic",)
+    opcode = Command.CANCEL.value
+
     def __init__(self, command, topic):
         super().__init__(command)
         self.topic = topic
     
-    def __repr__(self):
-        return super().__repr__() + f'"{self.command}", "topic": "{self.topic}"' + '}'
-    
     def pickleMsg(self):
         return {"command": self.command, "topic": self.topic}
+
+    def record(self):
+        return (self.opcode, self.topic)
     
-    def xmlMsg(self):
-        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}"></data>'
     
+class CreditMessage(Message):
+    """Message granting the broker credit to deliver more messages."""
+    __slots__ = ("credit",)
+    opcode = Command.CREDIT.value
+
+    def __init__(self, command, credit):
+        super().__init__(command)
+        self.credit = credit
+
+    def pickleMsg(self):
+        return {"command": self.command, "credit": self.credit}
+
+    def record(self):
+        return (self.opcode, self.credit)
+
+
+class PeerMessage(Message):
+    """Message announcing that a connection is a link to another broker."""
+    __slots__ = ("origin",)
+    opcode = Command.PEER.value
+
+    def __init__(self, command, origin):
+        super().__init__(command)
+        self.origin = origin
+
+    def pickleMsg(self):
+        return {"command": self.command, "origin": self.origin}
+
+    def record(self):
+        return (self.opcode, self.origin)
+
+
+class InterestMessage(Message):
+    """Message with all the topic prefixes a peer broker has subscribers for (or the brokers behind it).
+
+    topics maps each broker the prefixes originate from to (version, prefixes)."""
+    __slots__ = ("topics",)
+    opcode = Command.INTEREST.value
+
+    def __init__(self, command, topics):
+        super().__init__(command)
+        self.topics = topics
+
+    def pickleMsg(self):
+        return {"command": self.command, "topics": self.topics}
+
+    def record(self):
+        return (self.opcode, self.topics)
+
+
+class ShmMessage(Message):
+    """Message moving the data of a connection to shared-memory rings (upstream: client -> broker)."""
+    __slots__ = ("upstream", "downstream")
+    opcode = Command.SHM.value
+
+    def __init__(self, command, upstream, downstream):
+        super().__init__(command)
+        self.upstream = upstream
+        self.downstream = downstream
+
+    def pickleMsg(self):
+        return {"command": self.command, "upstream": self.upstream, "downstream": self.downstream}
+
+    def record(self):
+        return (self.opcode, self.upstream, self.downstream)
+
+
+class DoorbellMessage(Message):
+    """Notification that a shared-memory ring has new records (an empty DOORBELL frame on the wire)."""
+    __slots__ = ()
+
+    def __init__(self, command):
+        super().__init__(command)
+
+
 # class ReplyMessage(Message):
 #     def __init__(self, command, topic, value):
 #         super().__init__(command)
@@ -123,6 +409,37 @@ class CancelMessage(Message):
 #     def xmlMsg(self):
 #         return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic} value="{self.value}"></data>'
 
+# message class and command name of each pickle record, indexed by its command code
+_RECORDS = [
+    (SerializationMessage, "type"),
+    (SubMessage, "subscribe"),
+    (PubMessage, "publish"),
+    (AskListMessage, "ask"),
+    (ListMessage, "list"),
+    (CancelMessage, "cancel"),
+    (CreditMessage, "credit"),
+    (PeerMessage, "peer"),
+    (InterestMessage, "interest"),
+    (ShmMessage, "shm"),
+]
+
+# command name -> constructor of the message from the decoded fields (JSON, XML)
+_DECODERS = {
+    "type": lambda fields: SerializationMessage("type", int(fields["code"])),
+    "subscribe": lambda fields: SubMessage("subscribe", fields["topic"], fields.get("group")),
+    "publish": lambda fields: PubMessage(
+        "publish", fields["topic"], fields["value"], fields.get("origin"), int(fields["seq"]) if "seq" in fields else None,
+        fields.get("key")),
+    "ask": lambda fields: AskListMessage(
+        "ask", fields.get("prefix", ""), fields.get("cursor", ""), int(fields["limit"]) if "limit" in fields else None),
+    "list": lambda fields: ListMessage("list", fields["topics"], fields.get("cursor")),
+    "cancel": lambda fields: CancelMessage("cancel", fields["topic"]),
+    "credit": lambda fields: CreditMessage("credit", int(fields["credit"])),
+    "shm": lambda fields: ShmMessage("shm", fields["upstream"], fields["downstream"]),
+    "peer": lambda fields: PeerMessage("peer", fields["origin"]),
+    "interest": lambda fields: InterestMessage("interest", fields["topics"]),
+}
+
 class Protocol:
     """Protocol that implements the messages above"""
 
@@ -132,35 +449,136 @@ class Protocol:
         return SerializationMessage('type', code)
 
     @classmethod
-    def subscribe(cls, topic: str) -> SubMessage:
+    def subscribe(cls, topic: str, group: str = None) -> SubMessage:
         """Creates a SubMessage object."""
-        return SubMessage('subscribe', topic)
+        return SubMessage('subscribe', topic, group)
     
     @classmethod
-    def publish(cls, topic: str, value) -> PubMessage:
+    def publish(cls, topic: str, value, origin=None, seq=None, key=None) -> PubMessage:
         """Creates a PubMessage object."""
-        return PubMessage('publish', topic, value)
+        return PubMessage('publish', topic, value, origin, seq, key)
     
     @classmethod
-    def ask_list(cls) -> AskListMessage:
+    def ask_list(cls, prefix: str = "", cursor: str = "", limit: int = None) -> AskListMessage:
         """Creates a AskListMessage object."""
-        return AskListMessage('ask')
+        return AskListMessage('ask', prefix, cursor, limit)
 
     @classmethod
-    def list(cls, topics) -> ListMessage:
+    def list(cls, topics, cursor: str = None) -> ListMessage:
         """Creates a ListMessage object."""
-        return ListMessage('list', topics)
+        return ListMessage('list', topics, cursor)
     
     @classmethod
     def cancel(cls, topic: str) -> CancelMessage:
         """Creates a CancelMessage object."""
         return CancelMessage('cancel', topic)
     
+    @classmethod
+    def credit(cls, credit: int) -> CreditMessage:
+        """Creates a CreditMessage object."""
+        return CreditMessage('credit', credit)
+
+    @classmethod
+    def peer(cls, origin: str) -> PeerMessage:
+        """Creates a PeerMessage object."""
+        return PeerMessage('peer', origin)
+
+    @classmethod
+    def interest(cls, topics) -> InterestMessage:
+        """Creates a InterestMessage object."""
+        return InterestMessage('interest', topics)
+
+    @classmethod
+    def shm(cls, upstream: str, downstream: str) -> ShmMessage:
+        """Creates a ShmMessage object."""
+        return ShmMessage('shm', upstream, downstream)
+
+    @classmethod
+    def doorbell(cls) -> DoorbellMessage:
+        """Creates a DoorbellMessage object."""
+        return DoorbellMessage('ring')
+
+    @classmethod
+    def send_doorbell(cls, connection: socket):
+        """Rings the doorbell of the other side of a connection."""
+        connection.send(cls.header(DOORBELL, 0))
+
     # @classmethod
     # def reply(cls, topic: str, value: str) -> ReplyMessage:
     #     """Creates a ReplyMessage object."""
     #     return ReplyMessage('reply', topic, value)
 
+    @classmethod
+    def encode(cls, msg: Message, code) -> bytes:
+        """Serializes a Message object into the body of a frame."""
+        return cls.encode_parts(msg, code)[0]
+
+    @classmethod
+    def encode_parts(cls, msg: Message, code):
+        """Serializes a Message object into the body of a frame and its out-of-band buffers (pickle only)."""
+
+        if code == Serializer.JSON or code == 0:
+            return json.dumps(msg.pickleMsg()).encode('utf-8'), []
+
+        elif code == Serializer.XML or code == 1:
+            return msg.xmlMsg().encode('utf-8'), []
+
+        elif code == Serializer.PICKLE or code == 2:
+            record = msg.record()
+            value = _out_of_band(msg.value) if type(msg) is PubMessage else None
+            if value is None:
+                return pickle.dumps(record, protocol=5), []
+            record = record[:2] + (value,) + record[3:]
+            buffers = []
+            body = pickle.dumps(record, protocol=5, buffer_callback=buffers.append)
+            return body, [buffer.raw() for buffer in buffers]
+
+    @classmethod
+    def header(cls, code, length: int) -> bytes:
+        """Frame header: one byte with the encoding (JSON, XML or pickle) and 2 bytes of length, in big endian.
+
+        Out-of-band buffers (BUFFER) have 4 bytes of length."""
+        if code == BUFFER:
+            return code.to_bytes(1, 'big') + length.to_bytes(4, 'big')
+        return code.to_bytes(1, 'big') + length.to_bytes(2, 'big')
+
+    @classmethod
+    def frame_parts(cls, msg: Message, code) -> list:
+        """Frames of a Message object: each out-of-band buffer (header, buffer), then the message frame.
+
+        The buffers are not copied, send them with send_parts."""
+        if code == None: code=0
+        body, buffers = cls.encode_parts(msg, int(code))
+        parts = cls.buffer_parts(buffers)
+        parts.append(cls.header(int(code), len(body)) + body)
+        return parts
+
+    @classmethod
+    def buffer_parts(cls, buffers) -> list:
+        """Frames (header, buffer) of out-of-band buffers."""
+        parts = []
+        for buffer in buffers:
+            parts.append(cls.header(BUFFER, memoryview(buffer).nbytes))
+            parts.append(buffer)
+        return parts
+
+    @classmethod
+    def frame(cls, msg: Message, code) -> bytes:
+        """Complete frame(s) (header + body) of a Message object, for stream writers."""
+        return b''.join(cls.frame_parts(msg, code))
+
+    @classmethod
+    def send_parts(cls, connection: socket, parts):
+        """Sends a list of buffers with scatter/gather I/O, without joining them."""
+        parts = [memoryview(part).cast('B') for part in parts]
+        while parts:
+            sent = connection.sendmsg(parts)
+            while parts and sent >= parts[0].nbytes:
+                sent -= parts[0].nbytes
+                parts.pop(0)
+            if sent:
+                parts[0] = parts[0][sent:]
+
     @classmethod
     def send_msg(cls, connection: socket, msg: Message, code):
         """Sends through a connection a Message object."""
@@ -170,85 +588,239 @@ class Protocol:
         if type(code) == str:
             code = int(code)
 
+        message, buffers = cls.encode_parts(msg, code)
+        if buffers: # large pickled values: the out-of-band buffers go first, each in its own frame
+            cls.send_parts(connection, cls.buffer_parts(buffers))
         # one byte in big endian to refer to the encoding needed (JSON, XML or pickle)
         connection.send(code.to_bytes(1, 'big'))
+        # we need to send the length of message with a 2 byte big endian header
+        connection.send(len(message).to_bytes(2, 'big'))
+        # send the message
+        connection.send(message)
 
-        if code == Serializer.JSON or code == 0:
-            message = json.loads(msg.__repr__())
-            message = json.dumps(message).encode('utf-8')
-            # we need to send the length of message with a 2 byte big endian header
-            connection.send(len(message).to_bytes(2, 'big'))
-            # send the message
-            connection.send(message)
-
-        elif code == Serializer.XML or code == 1:
-            message = msg.xmlMsg().encode('utf-8')
-            # we need to send the length of message with a 2 byte big endian header
-            connection.send(len(message).to_bytes(2, 'big'))
-            # send the message
-            connection.send(message)
-
-        elif code == Serializer.PICKLE or code == 2:
-            message = pickle.dumps(msg.pickleMsg())
-            # we need to send the length of message with a 2 byte big endian header
-            connection.send(len(message).to_bytes(2, 'big'))
-            # send the message
-            connection.send(message)
+    @classmethod
+    def recv_exact(cls, connection: socket, size: int) -> bytes:
+        """Receives exactly size bytes, as recv may return less than asked."""
+        data = connection.recv(size)
+        if not data: # the peer closed the connection
+            raise ConnectionError("connection closed by peer")
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            data += chunk
+        return data
 
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
         """Receives through a connection a Message object."""
-        code = int.from_bytes(connection.recv(1), 'big')
-        miniHeader = int.from_bytes(connection.recv(2), 'big')
+        header = cls.recv_exact(connection, 3)
+        code = header[0]
+        miniHeader = int.from_bytes(header[1:], 'big')
+
+        buffers = []
+        while code == BUFFER:
+            length = int.from_bytes(header[1:] + cls.recv_exact(connection, 2), 'big')
+            buffers.append(bytearray(cls.recv_exact(connection, length)))
+            header = cls.recv_exact(connection, 3)
+            code = header[0]
+            miniHeader = int.from_bytes(header[1:], 'big')
+
+        if code == DOORBELL:
+            return cls.doorbell()
 
         if miniHeader == 0: # if there is no length
             return None
-        
-        try:
-            if code == 0:
-                tempMsg = connection.recv(miniHeader).decode('utf-8')
-                message = json.loads(tempMsg)
 
-            elif code == 1:
-                tempMsg = connection.recv(miniHeader).decode('utf-8')
-                message = {}
-                root = ET.fromstring(tempMsg)
-                for node in root.keys():
-                    message[node] = root.get(node)
+        return cls.decode(code, cls.recv_exact(connection, miniHeader), buffers)
 
-            elif code == 2:
-                tempMsg = connection.recv(miniHeader)
-                message = pickle.loads(tempMsg)
+    @classmethod
+    def split_frames(cls, buffer) -> Tuple[List[Tuple[int, bytes]], int]:
+        """Splits the complete frames at the start of buffer.
+
+        Returns the list of (code, body) and how many bytes were consumed.
+        Out-of-band buffers (code BUFFER) come as a bytearray that can be kept."""
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= 3:
+            size = 5 if buffer[offset] == BUFFER else 3
+            if len(buffer) - offset < size:
+                break
+            length = int.from_bytes(buffer[offset + 1:offset + size], 'big')
+            if len(buffer) - offset - size < length:
+                break
+            if buffer[offset] == BUFFER:
+                frames.append((BUFFER, bytearray(buffer[offset + size:offset + size + length])))
+            else:
+                frames.append((buffer[offset], bytes(buffer[offset + size:offset + size + length])))
+            offset += size + length
+        return frames, offset
 
-        except json.JSONDecodeError as err:
-            raise ProtocolBadFormat(tempMsg)
+    @classmethod
+    def decode_record(cls, record: bytes) -> Message:
+        """Deserializes a record of a shared-memory ring (a message frame after its buffer frames)."""
+        frames, _ = cls.split_frames(record)
+        buffers = [body for code, body in frames[:-1] if code == BUFFER]
+        code, body = frames[-1]
+        return cls.decode(code, body, buffers)
 
-        command = message["command"]
+    @classmethod
+    def decode(cls, code: int, data, buffers=None) -> Message:
+        """Deserializes the body of a frame (bytes or a memoryview of a receive buffer) into a Message object.
 
-        if command == "type":
-            return cls.serialize(message["code"])
+        buffers are the out-of-band buffers received before a pickle frame."""
+        if code == DOORBELL:
+            return cls.doorbell()
 
-        elif command == "subscribe":
-            return cls.subscribe(message["topic"])
+        try:
+            if code == 0:
+                message = json.loads(str(data, 'utf-8'))
 
-        elif command == "publish":
-            return cls.publish(message["topic"], message["value"])
+            elif code == 1:
+                message = xml_decode(str(data, 'utf-8'))
 
-        elif command == "ask":
-            return cls.ask_list()
-        
-        elif command == "list":
-            return cls.list(message["topics"])
-        
-        elif command == "cancel":
-            return cls.list(message["topic"])
+            elif code == 2:
+                message = pickle.loads(data, buffers=buffers)
+
+            else:
+                raise ProtocolBadFormat(data)
+
+        except (json.JSONDecodeError, pickle.UnpicklingError) as err:
+            raise ProtocolBadFormat(data)
+
+        if type(message) is tuple: # pickle record
+            try:
+                kind, command = _RECORDS[message[0]]
+                return kind(command, *message[1:])
+            except (IndexError, TypeError):
+                raise ProtocolBadFormat(data)
+
+        try: # fields of JSON and XML frames (and of the old pickle frames)
+            decoder = _DECODERS.get(message["command"])
+        except (KeyError, TypeError):
+            raise ProtocolBadFormat(data)
+        return None if decoder is None else decoder(message)
         
-        # elif command == "reply":
-        #     return cls.reply(message["topic"], message["value"])
-
+class FrameReader:
+    """Reusable receive buffer of a connection.
+
+    Data is read with recv_into and the frame bodies are handed out as
+    memoryview slices of the buffer, which stay valid until the next fill().
+    Out-of-band buffers are received straight into their own bytearray,
+    which the decoded value can keep. The buffer starts small (idle
+    connections are cheap), grows for larger frames and goes back to its
+    initial size once the traffic is light again."""
+
+    def __init__(self, connection: socket, size: int = 1 << 13):
+        self.connection = connection
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not parsed yet
+        self.end = 0 # end of the received data
+        self.buffers = [] # out-of-band buffers of the next message
+        self.partial = None # out-of-band buffer being received
+        self.filled = 0 # bytes of partial already received
+        self.light = True # whether the last receive fitted the initial size
+
+    def fill(self):
+        """Receive what is available (blocks if nothing is)."""
+        if self.partial is not None: # the rest of a large buffer goes directly to its place
+            received = self.connection.recv_into(memoryview(self.partial)[self.filled:])
+            if not received:
+                raise ConnectionError("connection closed by peer")
+            self.filled += received
+            if self.filled == len(self.partial):
+                self.buffers.append(self.partial)
+                self.partial = None
+            return
+
+        pending = self.end - self.start
+        if not pending and len(self.buffer) > self.size and self.light:
+            self.buffer = bytearray(self.size) # views handed out keep the large one alive
+            self.view = memoryview(self.buffer)
+            self.start = self.end = 0
+        if self.start and (self.end == len(self.buffer) or not pending):
+            # move the incomplete frame to the beginning (overlapping copies are safe in memoryview)
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.end == len(self.buffer): # a frame bigger than the buffer
+            self.grow(len(self.buffer) * 2)
+
+        received = self.connection.recv_into(self.view[self.end:])
+        if not received: # the peer closed the connection
+            raise ConnectionError("connection closed by peer")
+        self.end += received
+        self.light = received < self.size
+
+    def grow(self, size: int):
+        """Replace the buffer with a bigger one (views handed out keep the old one alive)."""
+        buffer = bytearray(size)
+        buffer[:self.end - self.start] = self.view[self.start:self.end]
+        self.buffer, self.view = buffer, memoryview(buffer)
+        self.start, self.end = 0, self.end - self.start
+
+    def _take_buffer(self) -> bool:
+        """Start receiving the out-of-band buffer whose frame begins at start; False if its header is incomplete."""
+        if self.end - self.start < 5:
+            return False
+        length = int.from_bytes(self.view[self.start + 1:self.start + 5], 'big')
+        available = min(self.end - self.start - 5, length)
+        buffer = bytearray(length)
+        buffer[:available] = self.view[self.start + 5:self.start + 5 + available]
+        self.start += 5 + available
+        if available == length:
+            self.buffers.append(buffer)
         else:
+            self.partial, self.filled = buffer, available
+        return True
+
+    def next_frame(self):
+        """Parse the next complete message frame, without receiving.
+
+        Returns (code, body view, whole frame view, out-of-band buffers) or None."""
+        while self.partial is None and self.end - self.start >= 3 and self.buffer[self.start] == BUFFER:
+            if not self._take_buffer():
+                return None
+        if self.partial is not None or self.end - self.start < 3:
             return None
-        
+
+        length = int.from_bytes(self.view[self.start + 1:self.start + 3], 'big')
+        if self.buffer[self.start] == DOORBELL:
+            length = 0
+        stop = self.start + 3 + length
+        if stop > self.end:
+            if stop - self.start > len(self.buffer):
+                self.grow(stop - self.start)
+            return None
+        frame = self.view[self.start:stop]
+        self.start = stop
+        buffers, self.buffers = self.buffers, []
+        return frame[0], frame[3:], frame, buffers
+
+    def frames(self):
+        """Every complete message frame already received."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def recv_frame(self):
+        """Block until a complete message frame is received."""
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
+
+    def recv_msg(self) -> Message:
+        """Block until a Message object is received."""
+        code, body, _, buffers = self.recv_frame()
+        if not body and code != DOORBELL: # if there is no length
+            return None
+        return Protocol.decode(code, body, buffers)
+
+
 class ProtocolBadFormat(Exception):
     """Exception when source message is not Protocol."""
 
@@ -0,0 +1,113 @@
+"""Shared-memory ring buffers for clients on the same host as the broker."""
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+# header: head (bytes ever written), tail (bytes ever read), consumer waiting flag
+_HEADER = struct.Struct("<QQB")
+_HEADER_SIZE = 64 # keep the data on its own cache line
+_LENGTH = struct.Struct("<I")
+_WRAP = 0xFFFFFFFF # record length marking the end of the data region was skipped
+
+_created = set() # names of the segments created (and owned) by this process
+
+
+class RingBuffer:
+    """Single-producer/single-consumer ring buffer of byte records in shared memory.
+
+    The consumer announces it is about to sleep with sleep(); the producer
+    then learns from need_wakeup() that it has to ring a doorbell (a byte on
+    the control connection), so doorbells are only sent when needed."""
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.name = shm.name
+        self.capacity = shm.size - _HEADER_SIZE
+        self._buf = shm.buf
+
+    @classmethod
+    def create(cls, capacity=1 << 20) -> "RingBuffer":
+        """Create a new segment; the creator is responsible for unlink()."""
+        shm = shared_memory.SharedMemory(create=True, size=_HEADER_SIZE + capacity)
+        _created.add(shm.name)
+        ring = cls(shm)
+        _HEADER.pack_into(ring._buf, 0, 0, 0, 1) # the consumer starts asleep
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> "RingBuffer":
+        """Attach to a segment created by the other side."""
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            # only the creator may unlink it, the tracker would remove it when we exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    def _positions(self):
+        head, tail, _ = _HEADER.unpack_from(self._buf, 0)
+        return head, tail
+
+    def write(self, data) -> bool:
+        """Append a record; False if there is no room for it now."""
+        size = _LENGTH.size + len(data)
+        if size > self.capacity // 2:
+            raise ValueError(f"record of {len(data)} bytes does not fit a {self.capacity} bytes ring")
+
+        head, tail = self._positions()
+        offset = head % self.capacity
+        skip = 0
+        if offset + size > self.capacity: # would cross the end, restart at the beginning
+            skip = self.capacity - offset
+        if head + skip + size - tail > self.capacity:
+            return False
+
+        if skip:
+            if skip >= _LENGTH.size:
+                _LENGTH.pack_into(self._buf, _HEADER_SIZE + offset, _WRAP)
+            offset = 0
+        _LENGTH.pack_into(self._buf, _HEADER_SIZE + offset, len(data))
+        start = _HEADER_SIZE + offset + _LENGTH.size
+        self._buf[start:start + len(data)] = data
+        struct.pack_into("<Q", self._buf, 0, head + skip + size) # publish the record
+        return True
+
+    def read(self):
+        """Pop the oldest record, or None if the ring is empty."""
+        head, tail = self._positions()
+        if head == tail:
+            return None
+
+        offset = tail % self.capacity
+        if self.capacity - offset < _LENGTH.size or _LENGTH.unpack_from(self._buf, _HEADER_SIZE + offset)[0] == _WRAP:
+            tail += self.capacity - offset
+            offset = 0
+        length = _LENGTH.unpack_from(self._buf, _HEADER_SIZE + offset)[0]
+        start = _HEADER_SIZE + offset + _LENGTH.size
+        data = bytes(self._buf[start:start + length])
+        struct.pack_into("<Q", self._buf, 8, tail + _LENGTH.size + length) # free the space
+        return data
+
+    def sleep(self) -> bool:
+        """Consumer side: mark as waiting for a doorbell, unless a record arrived meanwhile."""
+        self._buf[16] = 1
+        head, tail = self._positions()
+        if head != tail:
+            self._buf[16] = 0
+            return False
+        return True
+
+    def need_wakeup(self) -> bool:
+        """Producer side: whether the consumer is asleep and must get a doorbell (clears the flag)."""
+        if self._buf[16]:
+            self._buf[16] = 0
+            return True
+        return False
+
+    def close(self):
+        """Detach from the segment."""
+        self._buf = None
+        self.shm.close()
+
+    def unlink(self):
+        """Destroy the segment (creator only)."""
+        self.shm.unlink()
+        _created.discard(self.name)
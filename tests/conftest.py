@@ -16,3 +16,20 @@ def broker():
     yield broker
     broker.canceled = True
     thread.join(timeout=5)
+
+
+@pytest.fixture
+def make_broker():
+    """Start brokers on free ports, for tests that must not share the session broker."""
+    brokers = []
+
+    def start(**kwargs):
+        kwargs.setdefault("port", 0)
+        new = Broker(**kwargs)
+        threading.Thread(target=new.run, daemon=True).start()
+        brokers.append(new)
+        return new
+
+    yield start
+    for b in brokers:
+        b.canceled = True
@@ -0,0 +1,67 @@
+"""Test the asyncio middleware."""
+import asyncio
+
+import pytest
+
+from src.middleware import (
+    AsyncJSONQueue,
+    AsyncPickleQueue,
+    AsyncXMLQueue,
+    MiddlewareType,
+)
+
+
+def test_async_producer_consumers(make_broker):
+    broker = make_broker()
+
+    async def scenario():
+        consumers = [
+            await queue_type.connect("/async", port=broker._port)
+            for queue_type in (AsyncJSONQueue, AsyncPickleQueue, AsyncXMLQueue)
+        ]
+        await asyncio.sleep(0.1)
+
+        async with AsyncPickleQueue("/async", MiddlewareType.PRODUCER, port=broker._port) as producer:
+            for value in range(5):
+                await producer.push(value)
+
+        received = []
+        for consumer in consumers:
+            values = []
+            async for topic, value in consumer:
+                assert topic == "/async"
+                values.append(value)
+                if len(values) == 5:
+                    break
+            received.append(values)
+            await consumer.close()
+        return received
+
+    json_values, pickle_values, xml_values = asyncio.run(scenario())
+
+    assert json_values == [0, 1, 2, 3, 4]
+    assert pickle_values == json_values
+    assert xml_values == json_values
+
+
+def test_async_pull_many(make_broker):
+    broker = make_broker()
+
+    async def scenario():
+        consumer = await AsyncJSONQueue.connect("/batch", port=broker._port)
+        await asyncio.sleep(0.1)
+        producer = await AsyncJSONQueue.connect("/batch", MiddlewareType.PRODUCER, port=broker._port)
+        for value in range(10):
+            await producer.push(value)
+
+        values = []
+        while len(values) < 10:
+            batch = await consumer.pull_many(10)
+            assert 1 <= len(batch) <= 10
+            values.extend(value for _, value in batch)
+
+        await producer.close()
+        await consumer.close()
+        return values
+
+    assert asyncio.run(scenario()) == list(range(10))
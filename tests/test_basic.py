@@ -85,9 +85,7 @@ def test_multiple_consumers(consumer_JSON, consumer_Pickle, consumer_XML, broker
 
     assert consumer_JSON.received == prev + producer.produced
     assert consumer_Pickle.received == consumer_JSON.received
-    assert consumer_Pickle.received == [
-        int(v) for v in consumer_XML.received
-    ]  # XML only transfers strings, so we cast here into int for comparison
+    assert consumer_Pickle.received == consumer_XML.received  # XML values keep their type
 
     assert broker.list_topics() == [TOPIC]
 
@@ -0,0 +1,71 @@
+"""Test the traffic recorder."""
+import socket
+import time
+
+import pytest
+
+from src.capture import read_capture
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+from src.protocol import Protocol
+
+
+def record(make_broker, path, clients):
+    broker = make_broker(record=path)
+    queues = clients(broker._port)
+    time.sleep(0.1)
+    for queue in queues:
+        queue.close()
+    time.sleep(0.1)
+    broker.canceled = True
+    time.sleep(0.3)  # the loop stops and closes the capture
+    return broker
+
+
+def test_records_frames_as_received(make_broker, tmp_path):
+    path = tmp_path / "traffic.cap"
+
+    def clients(port):
+        producer = PickleQueue("/recorded", MiddlewareType.PRODUCER, port=port)
+        producer.push(b"\0" * 100_000)  # out-of-band buffer, recorded with its frame
+        return [producer, JSONQueue("/other", port=port)]
+
+    record(make_broker, path, clients)
+    records = list(read_capture(path))
+
+    producer = [data for _, conn_id, data in records if conn_id == 0]
+    consumer = [data for _, conn_id, data in records if conn_id == 1]
+    assert producer[0] == Protocol.frame(Protocol.serialize(2), 0)
+    assert consumer[:2] == [Protocol.frame(Protocol.serialize(0), 0), Protocol.frame(Protocol.subscribe("/other"), 0)]
+    assert producer[2] is None and consumer[2] is None  # closed
+    publish = Protocol.decode_record(producer[1])
+    assert (publish.topic, publish.value) == ("/recorded", b"\0" * 100_000)
+    assert [seconds for seconds, _, _ in records] == sorted(seconds for seconds, _, _ in records)
+
+
+@pytest.mark.parametrize("shm", [False, True])
+def test_replay_rebuilds_the_store(make_broker, tmp_path, shm):
+    path = tmp_path / "traffic.cap"
+
+    def clients(port):
+        producers = [PickleQueue(f"/replay/{i}", MiddlewareType.PRODUCER, port=port, shm=shm) for i in range(3)]
+        for i, producer in enumerate(producers):
+            producer.push(bytes(600_000))  # too big for the ring, through the socket
+            producer.push(i)
+        return producers
+
+    recorded = record(make_broker, path, clients)
+    broker = make_broker()
+    conns = {}
+    for _, conn_id, data in read_capture(path):
+        if conn_id not in conns:
+            conns[conn_id] = socket.create_connection(("localhost", broker._port))
+        if data is None:
+            conns[conn_id].close()
+        else:
+            conns[conn_id].sendall(data)
+    time.sleep(0.2)
+
+    commands = {Protocol.decode_record(data).command for _, _, data in read_capture(path) if data is not None}
+    assert commands == {"type", "publish"}  # shm clients are recorded as socket clients
+    assert broker.list_topics() == recorded.list_topics() == ["/replay/0", "/replay/1", "/replay/2"]
+    assert [broker.get_topic(topic) for topic in broker.list_topics()] == [0, 1, 2]
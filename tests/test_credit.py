@@ -0,0 +1,55 @@
+"""Test credit based flow control."""
+import functools
+import time
+
+import pytest
+
+from src.clients import Consumer, Producer
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+
+
+def gen():
+    value = 0
+    while True:
+        value += 1
+        yield value
+
+
+def test_broker_holds_messages_without_credit(make_broker):
+    broker = make_broker()
+
+    consumer = PickleQueue("/credit", port=broker._port, prefetch=2, auto_ack=False)
+    producer = JSONQueue("/credit", MiddlewareType.PRODUCER, port=broker._port)
+    for value in range(5):
+        producer.push(value)
+    time.sleep(0.2)
+
+    flow = next(iter(broker.flow.values()))
+    assert flow.credit == 0
+    assert flow.outstanding == 2
+    assert len(flow.pending) == 3
+
+    assert [consumer.pull()[1] for _ in range(2)] == [0, 1]
+    consumer.ack(2)
+    assert [consumer.pull()[1] for _ in range(2)] == [2, 3]
+    time.sleep(0.2)
+    assert len(flow.pending) == 1
+
+
+def test_consumer_prefetch(make_broker):
+    broker = make_broker()
+
+    consumer = Consumer("/prefetch", functools.partial(JSONQueue, port=broker._port), prefetch=3)
+    producer = Producer("/prefetch", gen, functools.partial(JSONQueue, port=broker._port))
+
+    producer.run(20)
+    consumer.run(20)
+
+    assert consumer.received == producer.produced
+
+
+def test_prefetch_needs_own_connection(make_broker):
+    broker = make_broker()
+
+    with pytest.raises(ValueError):
+        JSONQueue("/credit", port=broker._port, shared=True, prefetch=2)
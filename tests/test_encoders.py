@@ -0,0 +1,50 @@
+"""Test the parallel encoding pool."""
+import time
+
+import pytest
+
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_pool_keeps_topic_order(make_broker, executor):
+    broker = make_broker(encode_workers=2, executor=executor, encode_min=1 << 12)
+    consumers = [queue("/encoded", port=broker._port) for queue in (JSONQueue, XMLQueue, PickleQueue)]
+    producer = PickleQueue("/encoded", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    values = ["big" * 10000, 1, "large" * 5000, 2, 3]  # small values queue up behind the large ones
+    for value in values:
+        producer.push(value)
+
+    for consumer in consumers:
+        assert [consumer.pull()[1] for _ in values] == values
+    assert not broker._deliveries
+
+
+def test_small_topics_bypass_the_pool(make_broker):
+    broker = make_broker(encode_workers=1, encode_min=1 << 12)
+    consumer = JSONQueue("/small", port=broker._port)
+    producer = JSONQueue("/small", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(broker.encoder, "submit", None)  # would fail if used
+        producer.push(42)
+        assert consumer.pull() == ("/small", 42)
+
+
+def test_process_pool_leaves_pickle_to_the_loop(make_broker):
+    broker = make_broker(encode_workers=1, encode_min=1 << 12)  # processes by default
+    consumers = [queue("/offloaded", port=broker._port) for queue in (XMLQueue, PickleQueue)]
+    producer = PickleQueue("/offloaded", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    codes = []
+    submit = broker.encoder.submit
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(broker.encoder, "submit", lambda fn, *args: codes.append(args[2]) or submit(fn, *args))
+        producer.push("big" * 10000)
+        for consumer in consumers:
+            assert consumer.pull() == ("/offloaded", "big" * 10000)
+    assert codes == [1]  # only XML went to a worker
@@ -0,0 +1,83 @@
+"""Test broker federation."""
+import time
+
+import pytest
+
+from src.broker import aggregate_topics
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+from src.protocol import Protocol
+
+
+def test_aggregate_topics():
+    assert aggregate_topics(["/a/b", "/a", "/c", "/a"]) == ["/a", "/c"]
+
+
+def test_interest_from_a_client_is_ignored(make_broker):
+    broker = make_broker()
+    consumer = PickleQueue("/not/peer", port=broker._port)
+    consumer.socket.settimeout(2)
+    producer = PickleQueue("/not/peer", MiddlewareType.PRODUCER, port=broker._port)
+
+    Protocol.send_msg(producer.socket, Protocol.interest({"nobody": (1, ["/not"])}), 2)
+    producer.push(1)
+    assert consumer.pull() == ("/not/peer", 1)
+    assert not broker.peers
+
+
+def test_chain_forwards_on_interest(make_broker):
+    first = make_broker()
+    middle = make_broker(peers=[("localhost", first._port)])
+    last = make_broker(peers=[("localhost", middle._port)])
+    time.sleep(0.2)
+
+    consumer = PickleQueue("/fed", port=last._port)
+    time.sleep(0.2)
+    assert first.peers and next(iter(first.peers.values())).prefixes == ["/fed"]
+
+    producer = JSONQueue("/fed/temp", MiddlewareType.PRODUCER, port=first._port)
+    producer.push(21)
+    other = JSONQueue("/other", MiddlewareType.PRODUCER, port=first._port)
+    other.push(1)
+
+    assert consumer.pull() == ("/fed/temp", 21)
+    time.sleep(0.2)
+    assert middle.get_topic("/fed/temp") == 21
+    assert middle.get_topic("/other") is None  # nobody behind the link is interested
+
+
+def test_loop_delivers_once(make_broker):
+    first = make_broker(broker_id="first")
+    second = make_broker(broker_id="second", peers=[("localhost", first._port)])
+    third = make_broker(broker_id="third", peers=[("localhost", first._port), ("localhost", second._port)])
+    time.sleep(0.2)
+
+    consumers = [PickleQueue("/ring", port=b._port) for b in (first, second, third)]
+    time.sleep(0.2)
+
+    producer = JSONQueue("/ring", MiddlewareType.PRODUCER, port=second._port)
+    producer.push(1)
+    producer.push(2)
+
+    for consumer in consumers:
+        assert [consumer.pull()[1] for _ in range(2)] == [1, 2]
+        consumer.socket.settimeout(0.3)
+        with pytest.raises(OSError):  # no duplicate arrives
+            consumer.pull()
+
+
+def test_unsubscribe_in_a_loop(make_broker):
+    first = make_broker(broker_id="first")
+    second = make_broker(broker_id="second", peers=[("localhost", first._port)])
+    third = make_broker(broker_id="third", peers=[("localhost", first._port), ("localhost", second._port)])
+    leaf = make_broker(broker_id="leaf", peers=[("localhost", first._port)])  # outside the loop
+    brokers = (first, second, third, leaf)
+    time.sleep(0.2)
+
+    consumers = [PickleQueue("/ghost", port=b._port) for b in (third, leaf)]
+    time.sleep(0.3)
+    assert all(["/ghost"] in [peer.prefixes for peer in b.peers.values()] for b in (first, second))
+
+    for consumer in consumers:
+        consumer.close()
+    time.sleep(0.3)
+    assert all(peer.prefixes == [] for b in brokers for peer in b.peers.values())
@@ -0,0 +1,101 @@
+"""Test consumer groups."""
+import time
+from collections import defaultdict
+
+import pytest
+
+from src.broker import partition
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from src.protocol import Protocol
+
+
+def pull_all(queue, n):
+    queue.socket.settimeout(2)  # fail instead of hanging if a message went elsewhere
+    return [queue.pull()[1] for _ in range(n)]
+
+
+def test_group_shares_messages(make_broker):
+    broker = make_broker()
+    members = [PickleQueue("/jobs", port=broker._port, group="workers") for _ in range(2)]
+    watcher = JSONQueue("/jobs", port=broker._port)
+    producer = PickleQueue("/jobs", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    for value in range(6):
+        producer.push(value)
+
+    shares = [pull_all(member, 3) for member in members]
+    assert sorted(shares[0] + shares[1]) == list(range(6))
+    assert pull_all(watcher, 6) == list(range(6))  # plain subscribers still get everything
+
+
+def test_same_key_same_member_in_order(make_broker):
+    broker = make_broker()
+    members = [queue("/orders", port=broker._port, group="billing") for queue in (PickleQueue, XMLQueue, JSONQueue)]
+    producer = PickleQueue("/orders", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    keys = ["alice", "bob", "carol", 7]
+    for i in range(12):
+        producer.push(i, key=keys[i % len(keys)])
+
+    expected = defaultdict(list)
+    for i in range(12):
+        expected[partition(keys[i % len(keys)], 3)].append(i)
+    for index, member in enumerate(members):
+        assert pull_all(member, len(expected[index])) == expected[index]
+
+
+def test_members_take_over_on_disconnect(make_broker):
+    broker = make_broker()
+    slow = PickleQueue("/failover", port=broker._port, group="g", prefetch=1, auto_ack=False)
+    other = PickleQueue("/failover", port=broker._port, group="g")
+    producer = PickleQueue("/failover", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    for value in range(6):
+        producer.push(value)
+    first = pull_all(slow, 1)
+    time.sleep(0.1)
+    slow.close()  # its held back share goes to the other member
+    time.sleep(0.1)
+
+    assert sorted(first + pull_all(other, 5)) == list(range(6))
+    assert len(broker.groups["/failover"]["g"].members) == 1
+
+
+def test_least_outstanding(make_broker):
+    broker = make_broker(group_selection="least-outstanding")
+    busy = PickleQueue("/least", port=broker._port, group="g", prefetch=1, auto_ack=False)
+    free = PickleQueue("/least", port=broker._port, group="g")
+    producer = PickleQueue("/least", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    for value in range(6):
+        producer.push(value)
+    time.sleep(0.1)
+
+    flow = next(iter(broker.flow.values()))  # busy is the only client with credit
+    assert flow.outstanding + len(flow.pending) <= 1
+    assert len(pull_all(free, 6 - flow.outstanding - len(flow.pending))) >= 5
+
+
+
+def test_only_group_deliveries_move_on_disconnect(make_broker):
+    broker = make_broker()
+    slow = PickleQueue("/both", port=broker._port, group="g", prefetch=1, auto_ack=False)
+    slow._send(Protocol.subscribe("/both"))  # also a plain subscriber
+    other = PickleQueue("/both", port=broker._port, group="g")
+    producer = PickleQueue("/both", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    for value in range(4):
+        producer.push(value)
+    time.sleep(0.1)
+    slow.close()  # holding its group share (0 and 2) and its own copies, only the share moves
+    time.sleep(0.1)
+
+    assert sorted(pull_all(other, 4)) == [0, 1, 2, 3]
+    other.socket.settimeout(0.3)
+    with pytest.raises(OSError):  # nothing more, none of the plain copies
+        other.pull()
@@ -0,0 +1,96 @@
+"""Test the non-blocking handshake."""
+import errno
+import socket
+import time
+
+from src.middleware import JSONQueue, MiddlewareType
+from src.protocol import FrameReader, Protocol
+
+PICKLE = 2
+
+
+def test_silent_client_does_not_block_the_broker(make_broker):
+    broker = make_broker()
+    silent = socket.create_connection(("localhost", broker._port))  # never sends its handshake
+    time.sleep(0.1)
+
+    consumer = JSONQueue("/silent", port=broker._port)
+    producer = JSONQueue("/silent", MiddlewareType.PRODUCER, port=broker._port)
+    producer.push(1)
+
+    assert consumer.pull() == ("/silent", 1)
+    silent.close()
+
+
+def test_handshake_pipelined_with_first_messages(make_broker):
+    broker = make_broker()
+    conn = socket.create_connection(("localhost", broker._port))
+    conn.sendall(
+        Protocol.frame(Protocol.serialize(PICKLE), 0)
+        + Protocol.frame(Protocol.subscribe("/pipelined"), PICKLE)
+        + Protocol.frame(Protocol.publish("/pipelined", "value"), PICKLE)
+    )
+
+    message = FrameReader(conn).recv_msg()
+    assert (message.topic, message.value) == ("/pipelined", "value")
+    conn.close()
+
+
+def test_accepts_every_waiting_connection(make_broker):
+    broker = make_broker()
+    clients = [socket.create_connection(("localhost", broker._port)) for _ in range(50)]
+    for client in clients:
+        client.sendall(Protocol.frame(Protocol.serialize(0), 0))
+    time.sleep(0.3)
+
+    assert len(broker.socketSerialization) == 50
+    for client in clients:
+        client.close()
+    time.sleep(0.3)
+    assert not broker.socketSerialization and not broker.readers
+
+
+def test_bad_handshake_closes_the_connection(make_broker):
+    broker = make_broker()
+    conn = socket.create_connection(("localhost", broker._port))
+    conn.sendall(Protocol.frame(Protocol.subscribe("/no/handshake"), 0))
+    conn.settimeout(2)
+
+    assert conn.recv(1) == b""
+    assert not broker.readers
+    conn.close()
+
+
+def test_unknown_command_is_ignored(make_broker):
+    broker = make_broker()
+    conn = socket.create_connection(("localhost", broker._port))
+    unknown = b'{"command": "foo"}'
+    conn.sendall(Protocol.frame(Protocol.serialize(0), 0) + Protocol.header(0, len(unknown)) + unknown)
+    time.sleep(0.1)
+
+    consumer = JSONQueue("/after/foo", port=broker._port)  # the broker is still serving
+    consumer.socket.settimeout(2)
+    JSONQueue("/after/foo", MiddlewareType.PRODUCER, port=broker._port).push(1)
+    assert consumer.pull() == ("/after/foo", 1)
+    assert len(broker.readers) == 3  # the sender of the unknown command was not dropped
+    conn.close()
+
+
+def test_out_of_descriptors_pauses_accepting(make_broker, monkeypatch):
+    broker = make_broker()
+    accept, calls = socket.socket.accept, []
+
+    def exhausted(sock):
+        calls.append(sock)
+        raise OSError(errno.EMFILE, "Too many open files")
+
+    monkeypatch.setattr(socket.socket, "accept", exhausted)
+    client = socket.create_connection(("localhost", broker._port))  # waits in the backlog
+    time.sleep(0.25)
+    assert 1 <= len(calls) <= 4  # retried after each pause, not in a busy loop
+
+    monkeypatch.setattr(socket.socket, "accept", accept)
+    client.sendall(Protocol.frame(Protocol.serialize(0), 0))
+    time.sleep(0.3)
+    assert len(broker.socketSerialization) == 1
+    client.close()
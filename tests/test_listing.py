@@ -0,0 +1,91 @@
+"""Test the paginated topic listing."""
+import asyncio
+import time
+
+import pytest
+
+from src.middleware import AsyncJSONQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from src.protocol import Protocol
+
+
+def test_list_page(make_broker):
+    broker = make_broker()
+    for topic in ["/b/2", "/a/1", "/b/1", "/a/2", "/c", "/b/3"]:
+        broker.put_topic(topic, 0)
+
+    assert broker.list_page("/b", "", 2) == (["/b/1", "/b/2"], "/b/2")
+    assert broker.list_page("/b", "/b/2", 2) == (["/b/3"], None)
+    assert broker.list_page("", "", 10) == (["/a/1", "/a/2", "/b/1", "/b/2", "/b/3", "/c"], None)
+    assert broker.list_page("/d") == ([], None)
+
+
+def test_list_page_cache_follows_new_topics(make_broker):
+    broker = make_broker()
+    broker.put_topic("/x/1", 0)
+    first = broker.list_page("/x")
+    assert broker.list_page("/x") is first  # served from the cache
+
+    broker.put_topic("/x/1", 1)  # same topics, the cache stays
+    assert broker.list_page("/x") is first
+    broker.put_topic("/x/0", 0)
+    assert broker.list_page("/x") == (["/x/0", "/x/1"], None)
+
+
+def test_pages_of_non_ascii_topics_fit_a_frame(make_broker):
+    broker = make_broker()
+    topics = [f'/é/"{"日本語" * 8}{i}' for i in range(2000)]
+    for topic in topics:
+        broker.put_topic(topic, 0)
+
+    listed, cursor = [], ""
+    while cursor is not None:
+        page, cursor = broker.list_page("", cursor, 1000)
+        for code in (0, 1, 2):
+            assert len(Protocol.frame(Protocol.list(page, cursor), code)) <= 1 << 16
+        listed += page
+    assert listed == sorted(topics)
+
+
+@pytest.mark.parametrize("queue_type", [JSONQueue, XMLQueue, PickleQueue])
+def test_queue_browses_pages(make_broker, queue_type):
+    broker = make_broker()
+    for i in range(7):
+        broker.put_topic(f"/browse/{i}", i)
+    broker.put_topic("/other", 0)
+
+    pages = []
+    queue = queue_type("/browse/x", MiddlewareType.PRODUCER, port=broker._port)
+    queue.list_topics(pages.append, prefix="/browse/", limit=3)
+
+    assert pages == [["/browse/0", "/browse/1", "/browse/2"], ["/browse/3", "/browse/4", "/browse/5"], ["/browse/6"]]
+
+
+def test_publishes_during_listing_are_kept(make_broker):
+    broker = make_broker()
+    consumer = PickleQueue("/kept", port=broker._port)
+    producer = PickleQueue("/kept", MiddlewareType.PRODUCER, port=broker._port)
+    producer.push("value")
+    time.sleep(0.1)
+
+    pages = []
+    consumer.list_topics(pages.append)
+
+    assert pages == [["/kept"]]
+    assert consumer.pull() == ("/kept", "value")
+
+
+def test_async_list_topics(make_broker):
+    broker = make_broker()
+    for i in range(3):
+        broker.put_topic(f"/aio/{i}", i)
+
+    async def browse():
+        async with AsyncJSONQueue("/aio/0", port=broker._port) as queue:
+            first = await queue.list_topics("/aio", limit=2)
+            second = await queue.list_topics("/aio", first[1], limit=2)
+            return first, second, await queue.pull()
+
+    first, second, item = asyncio.run(browse())
+    assert first == (["/aio/0", "/aio/1"], "/aio/1")
+    assert second == (["/aio/2"], None)
+    assert item == ("/aio/0", 0)
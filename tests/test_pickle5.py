@@ -0,0 +1,96 @@
+"""Test large binary values through the broker."""
+import array
+import asyncio
+import time
+
+import pytest
+
+from src import protocol
+from src.middleware import AsyncPickleQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+
+IMAGE = bytes(range(256)) * 4096  # 1 MiB
+SAMPLES = array.array("f", range(100000))
+
+
+def test_large_values_through_broker(make_broker):
+    broker = make_broker()
+
+    consumer = PickleQueue("/sensor", port=broker._port)
+    shared = PickleQueue("/sensor", port=broker._port, shared=True)
+    producer = PickleQueue("/sensor", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    producer.push(IMAGE)
+    producer.push(SAMPLES)
+    producer.push(bytearray(IMAGE))
+
+    for queue in (consumer, shared):
+        assert queue.pull() == ("/sensor", IMAGE)
+        assert queue.pull() == ("/sensor", SAMPLES)
+        topic, value = queue.pull()
+        assert type(value) is bytearray and value == IMAGE
+
+    assert broker.get_topic("/sensor") == IMAGE
+
+    late = PickleQueue("/sensor", port=broker._port)  # stored value is sent out of band too
+    assert late.pull()[1] == IMAGE
+
+
+def test_async_large_values(make_broker):
+    broker = make_broker()
+
+    async def scenario():
+        consumer = await AsyncPickleQueue.connect("/sensor", port=broker._port)
+        await asyncio.sleep(0.1)
+        producer = PickleQueue("/sensor", MiddlewareType.PRODUCER, port=broker._port)
+        producer.push(SAMPLES)
+        message = await consumer.pull()
+        await consumer.close()
+        return message
+
+    assert asyncio.run(scenario()) == ("/sensor", SAMPLES)
+
+
+def test_broker_copies_and_pickling(make_broker, monkeypatch):
+    """The broker decodes a large bytes value (one copy, like every receiver) but does not pickle it again."""
+    broker = make_broker()
+    consumers = [PickleQueue("/copies", port=broker._port) for _ in range(2)]
+    producer = PickleQueue("/copies", MiddlewareType.PRODUCER, port=broker._port)
+    time.sleep(0.1)
+
+    copies, dumps = [], []
+    rebuild, pickle_dumps = protocol._rebuild_buffer, protocol.pickle.dumps
+
+    def counting(kind, buffer):
+        copies.append(kind)
+        return rebuild(kind, buffer)
+
+    counting.__module__, counting.__qualname__ = rebuild.__module__, rebuild.__qualname__  # pickled by reference
+    monkeypatch.setattr(protocol, "_rebuild_buffer", counting)
+    monkeypatch.setattr(protocol.pickle, "dumps", lambda *args, **kwargs: dumps.append(1) or pickle_dumps(*args, **kwargs))
+
+    producer.push(IMAGE)
+    for consumer in consumers:
+        assert consumer.pull() == ("/copies", IMAGE)
+
+    assert len(dumps) == 1  # the producer only, the broker sends the frames as received
+    assert copies == ["bytes"] * 3  # the broker and each consumer
+
+
+@pytest.mark.parametrize("encode_workers", [0, 1])
+def test_values_other_codecs_cannot_carry(make_broker, encode_workers):
+    broker = make_broker(encode_workers=encode_workers)
+    binary = PickleQueue("/mixed", port=broker._port)
+    texts = [XMLQueue("/mixed", port=broker._port), JSONQueue("/mixed", port=broker._port)]
+    producer = PickleQueue("/mixed", MiddlewareType.PRODUCER, port=broker._port)
+    for queue in [binary] + texts:
+        queue.socket.settimeout(2)
+    time.sleep(0.1)
+
+    producer.push(bytes(20000))  # too long for an XML frame as text, not JSON serializable
+    producer.push("text")
+
+    assert binary.pull() == ("/mixed", bytes(20000))
+    assert binary.pull() == ("/mixed", "text")
+    for queue in texts:  # skipped, the broker keeps serving them
+        assert queue.pull() == ("/mixed", "text")
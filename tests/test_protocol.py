@@ -0,0 +1,130 @@
+"""Test the message encodings."""
+import array
+import pickle
+import socket
+
+import pytest
+
+from src.protocol import Command, FrameReader, Protocol, ProtocolBadFormat
+
+XML = 1
+PICKLE = 2
+
+MESSAGES = [
+    Protocol.serialize(2),
+    Protocol.subscribe("/t"),
+    Protocol.publish("/t", [1, "a"]),
+    Protocol.publish("/t", 3.5, "broker", 7),
+    Protocol.ask_list(),
+    Protocol.list(["/a", "/b"]),
+    Protocol.cancel("/t"),
+    Protocol.credit(10),
+    Protocol.peer("broker"),
+    Protocol.interest(["/a"]),
+    Protocol.shm("up", "down"),
+]
+
+
+@pytest.mark.parametrize("code", [0, XML, PICKLE])
+@pytest.mark.parametrize("message", MESSAGES, ids=lambda message: message.command)
+def test_messages_roundtrip(message, code):
+    decoded = Protocol.decode(code, Protocol.encode(message, code))
+
+    assert type(decoded) is type(message)
+    assert decoded.pickleMsg() == message.pickleMsg()
+
+
+def test_pickle_sends_compact_records():
+    message = Protocol.publish("/t", 1)
+
+    assert pickle.loads(Protocol.encode(message, PICKLE)) == (Command.PUBLISH, "/t", 1)
+    assert not hasattr(message, "__dict__")
+
+    old = pickle.dumps({"command": "cancel", "topic": "/t"})  # the previous dict frames still decode
+    assert Protocol.decode(PICKLE, old).pickleMsg() == {"command": "cancel", "topic": "/t"}
+
+
+@pytest.mark.parametrize(
+    "value", [42, -1.25, "text", "", ["a", 1, [2.5]], {"k": "v"}, True, None]
+)
+def test_xml_keeps_value_types(value):
+    message = Protocol.decode(XML, Protocol.encode(Protocol.publish("/t", value), XML))
+
+    assert message.value == value
+    assert type(message.value) is type(value)
+
+
+def test_xml_tuples_arrive_as_lists_like_json():
+    value = (1, "a", (2.5,))
+    decoded = [Protocol.decode(code, Protocol.encode(Protocol.publish("/t", value), code)).value for code in (0, XML)]
+
+    assert decoded == [[1, "a", [2.5]]] * 2
+
+
+def test_xml_escapes_attributes():
+    topic = '/a "quoted" <tag> & more\n'
+    data = Protocol.encode(Protocol.publish(topic, 'v="1"'), XML)
+
+    assert data.count(b"<") == data.count(b">") == 1
+    message = Protocol.decode(XML, data)
+    assert message.topic == topic
+    assert message.value == 'v="1"'
+
+
+def test_xml_lists_and_old_frames():
+    assert Protocol.decode(XML, Protocol.encode(Protocol.list(["/a", "/b"]), XML)).topics == ["/a", "/b"]
+
+    old = b'<?xml version="1.0"?><data command="publish" topic="/t" value="3"></data>'
+    message = Protocol.decode(XML, old)
+    assert (message.topic, message.value) == ("/t", "3")
+
+    with pytest.raises(ProtocolBadFormat):
+        Protocol.decode(XML, b"not xml")
+
+
+def test_pickle_large_values_go_out_of_band():
+    value = bytearray(range(256)) * 1024
+    parts = Protocol.frame_parts(Protocol.publish("/t", value), 2)
+
+    assert len(parts) == 3  # buffer header, the buffer itself (not copied), message frame
+    assert parts[1].obj is value
+    assert len(parts[2]) < 200
+
+    record = b"".join(parts)
+    reader = FrameReader(None, size=len(record))
+    reader.view[: len(record)] = record
+    reader.end = len(record)
+    code, body, _, buffers = reader.next_frame()
+    message = Protocol.decode(code, body, buffers)
+
+    assert message.value == value
+    assert message.value is buffers[0]  # rebuilt around the received buffer
+
+
+@pytest.mark.parametrize(
+    "value",
+    [b"x" * 100000, bytearray(70000), array.array("d", range(5000)), [b"a" * 20000, 1]],
+)
+def test_pickle_out_of_band_roundtrip(value):
+    message = Protocol.decode_record(Protocol.frame(Protocol.publish("/t", value), 2))
+
+    assert message.value == value
+    assert type(message.value) is type(value)
+
+
+def test_frame_reader_grows_and_shrinks_back():
+    left, right = socket.socketpair()
+    reader = FrameReader(right, size=1 << 12)
+    large = Protocol.publish("/t", "x" * 50000)
+
+    left.sendall(Protocol.frame(large, 0))
+    assert reader.recv_msg().value == large.value
+    assert len(reader.buffer) >= 50000
+
+    for i in range(3):  # light traffic again
+        left.sendall(Protocol.frame(Protocol.publish("/t", i), 0))
+        assert reader.recv_msg().value == i
+    assert len(reader.buffer) == 1 << 12
+
+    left.close()
+    right.close()
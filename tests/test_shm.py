@@ -0,0 +1,111 @@
+"""Test the shared-memory ring transport."""
+import socket
+import time
+
+import pytest
+
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+from src.protocol import DOORBELL, Protocol
+from src.shm import RingBuffer
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer.create(64)
+    reader = RingBuffer.attach(ring.name)
+
+    received = []
+    for i in range(200):
+        while not ring.write(bytes([i]) * (i % 13)):
+            received.append(reader.read())
+    while (record := reader.read()) is not None:
+        received.append(record)
+
+    assert received == [bytes([i]) * (i % 13) for i in range(200)]
+
+    reader.close()
+    ring.close()
+    ring.unlink()
+
+
+def test_doorbell_only_when_asleep():
+    ring = RingBuffer.create(1024)
+
+    assert ring.write(b"a") and ring.need_wakeup()  # the consumer starts asleep
+    assert ring.write(b"b") and not ring.need_wakeup()
+    assert ring.sleep() is False  # records pending, do not sleep
+    ring.read(), ring.read()
+    assert ring.sleep() is True
+    assert ring.write(b"c") and ring.need_wakeup()
+
+    ring.close()
+    ring.unlink()
+
+
+def test_shm_producer_consumer(make_broker):
+    broker = make_broker()
+
+    consumer = PickleQueue("/shm", port=broker._port, shm=True)
+    tcp_consumer = JSONQueue("/shm", port=broker._port)
+    producer = PickleQueue("/shm", MiddlewareType.PRODUCER, port=broker._port, shm=True)
+    time.sleep(0.1)
+
+    for value in range(100):
+        producer.push(value)
+
+    assert [consumer.pull()[1] for _ in range(100)] == list(range(100))
+    assert [tcp_consumer.pull()[1] for _ in range(100)] == list(range(100))
+
+    for queue in (consumer, tcp_consumer, producer):
+        queue.close()
+
+
+@pytest.mark.parametrize("capacity", [1 << 20, 1 << 12])
+def test_shm_publish_too_big_for_the_ring(make_broker, capacity):
+    broker = make_broker()
+    consumer = PickleQueue("/shm/big", port=broker._port)
+    producer = PickleQueue("/shm/big", MiddlewareType.PRODUCER, port=broker._port, shm=True, shm_capacity=capacity)
+    time.sleep(0.1)
+
+    values = [1, bytes(600_000), 2, "x" * 2000, 3]  # the large ones go through the socket, in order
+    for value in values:
+        producer.push(value)
+
+    assert [consumer.pull()[1] for _ in values] == values
+    consumer.close()
+    producer.close()
+
+
+def test_announced_publish_does_not_block_the_broker(make_broker):
+    broker = make_broker()
+    consumer = PickleQueue("/shm/slow", port=broker._port)
+    other = JSONQueue("/tcp", port=broker._port)
+    other.socket.settimeout(1)
+    producer = PickleQueue("/shm/slow", MiddlewareType.PRODUCER, port=broker._port, shm=True)
+    time.sleep(0.1)
+
+    upstream = producer._rings[0]
+    upstream.write(Protocol.header(DOORBELL, 0))  # a publish too big for the ring, still on its way
+    if upstream.need_wakeup():
+        Protocol.send_doorbell(producer.socket)
+    producer.push(1)  # behind it in the ring
+    JSONQueue("/tcp", MiddlewareType.PRODUCER, port=broker._port).push(2)
+    assert other.pull() == ("/tcp", 2)
+
+    Protocol.send_msg(producer.socket, Protocol.publish("/shm/slow", "big"), 2)
+    assert [consumer.pull()[1] for _ in range(2)] == ["big", 1]
+    producer.close()
+
+
+def test_bad_shm_messages(make_broker):
+    broker = make_broker()
+    consumer = JSONQueue("/shm/stray", port=broker._port)
+    consumer.socket.settimeout(2)
+    Protocol.send_doorbell(consumer.socket)  # no rings, ignored
+    JSONQueue("/shm/stray", MiddlewareType.PRODUCER, port=broker._port).push(1)
+    assert consumer.pull() == ("/shm/stray", 1)
+
+    conn = socket.create_connection(("localhost", broker._port))
+    conn.sendall(Protocol.frame(Protocol.serialize(2), 0) + Protocol.frame(Protocol.shm("no-such-ring", "nor-this"), 2))
+    conn.settimeout(2)
+    assert conn.recv(1) == b""  # the client cannot use its rings, it is disconnected
+    conn.close()
@@ -0,0 +1,109 @@
+"""Test the memory-bounded topic store."""
+import sys
+import time
+
+from src.broker import TimingWheel, value_size
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+
+
+def test_timing_wheel_expires_in_order():
+    wheel = TimingWheel(tick=0.01, slots=8)
+    wheel.schedule("late", 0.2)  # more than a round of the wheel away
+    wheel.schedule("soon", 0.02)
+    wheel.schedule("cancelled", 0.02)
+    wheel.cancel("cancelled")
+
+    time.sleep(0.05)
+    assert wheel.advance() == ["soon"]
+    assert wheel.advance() == []
+    time.sleep(0.2)
+    assert wheel.advance() == ["late"]
+    assert not wheel.deadlines
+
+
+def test_value_size_counts_the_contents():
+    strings = ["x" * 1000 for _ in range(1000)]
+    assert value_size(strings) > 1000 * 1000
+    assert value_size({"a": (b"y" * 1000, [1.5])}) > 1000
+    assert value_size("x" * 1000) == sys.getsizeof("x" * 1000)
+
+
+def test_values_expire_after_their_ttl(make_broker):
+    broker = make_broker(ttl=10, ttls={"/short": 0.2})
+    producer = PickleQueue("/short/lived", MiddlewareType.PRODUCER, port=broker._port)
+    producer.push(1)
+    broker.put_topic("/long/lived", 2)
+    time.sleep(0.1)
+    assert broker.list_topics() == ["/long/lived", "/short/lived"]
+
+    time.sleep(0.4)
+    assert broker.list_topics() == ["/long/lived"]
+    assert broker.get_topic("/short/lived") is None
+    assert broker.memory_stats()["expired"] == 1
+
+    consumer = JSONQueue("/short/lived", port=broker._port)  # nothing stored left to send it
+    consumer.socket.settimeout(0.3)
+    producer.push(3)
+    assert consumer.pull() == ("/short/lived", 3)
+
+
+def test_lru_eviction_keeps_subscribed_topics(make_broker):
+    value = "x" * 1000
+    size = sys.getsizeof("/lru/0") + sys.getsizeof(value)
+    broker = make_broker(max_bytes=3 * size)
+    consumer = JSONQueue("/lru/0", port=broker._port)
+    time.sleep(0.1)
+
+    for i in range(3):
+        broker.put_topic(f"/lru/{i}", value)
+    for i in range(3, 5):
+        broker.get_topic("/lru/1")  # kept in use
+        broker.put_topic(f"/lru/{i}", value)  # evicts /lru/2 then /lru/3, /lru/0 is subscribed
+
+    assert broker.list_topics() == ["/lru/0", "/lru/1", "/lru/4"]
+    stats = broker.memory_stats()
+    assert stats["evicted"] == 2 and stats["bytes"] == 3 * size <= stats["max_bytes"]
+    assert consumer.pull() == ("/lru/0", value)
+
+
+def test_eviction_accounts_nested_values(make_broker):
+    broker = make_broker(max_bytes=1 << 20)
+    broker.put_topic("/nested/0", ["x" * 1000 for _ in range(1000)])
+    broker.put_topic("/nested/1", ["x" * 1000 for _ in range(1000)])  # over 1 MiB with the first one
+
+    assert broker.list_topics() == ["/nested/1"]
+    assert broker.memory_stats()["evicted"] == 1
+
+
+def test_subscribed_values_are_not_eviction_candidates(make_broker):
+    broker = make_broker(max_bytes=1)  # a budget the subscribed values alone exceed
+    consumer = JSONQueue("/kept", port=broker._port)
+    time.sleep(0.1)
+
+    for i in range(200):
+        broker.put_topic(f"/kept/{i}", i)
+        broker.put_topic(f"/loose/{i}", i)
+    assert broker.memory_stats()["evictable"] == 1  # only the last loose value, kept while being stored
+    assert len(broker.list_topics()) == 201
+
+    consumer.close()  # nobody receives /kept anymore
+    time.sleep(0.2)
+    assert broker.memory_stats()["evictable"] == 201
+    broker.put_topic("/loose/last", 0)
+    assert broker.list_topics() == ["/loose/last"]
+
+
+def test_no_empty_subscriber_lists(make_broker):
+    broker = make_broker()
+    for i in range(100):
+        broker.put_topic(f"/nobody/{i}", i)
+    assert not broker.subscribers
+
+    consumer = JSONQueue("/some", port=broker._port)
+    time.sleep(0.1)
+    broker.put_topic("/some/thing", 1)
+    assert set(broker.subscribers) == {"/some", "/some/thing"}
+
+    consumer.close()
+    time.sleep(0.2)
+    assert not broker.subscribers
@@ -0,0 +1,120 @@
+"""Test the process-wide shared transport."""
+import socket
+import time
+from queue import SimpleQueue
+
+import pytest
+
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue, TransportManager
+from src.protocol import Protocol
+
+
+def test_queues_share_pooled_connections(make_broker):
+    broker = make_broker()
+    manager = TransportManager(pool_size=2)
+
+    conns = [manager.acquire("localhost", broker._port, 2) for _ in range(5)]
+
+    assert len({id(conn) for conn in conns}) == 2
+    assert manager.acquire("localhost", broker._port, 0) not in conns
+
+    manager.close_all()
+
+
+def test_shared_consumers_receive(make_broker):
+    broker = make_broker()
+
+    consumer1 = PickleQueue("/shared", port=broker._port, shared=True)
+    consumer2 = PickleQueue("/shared", port=broker._port, shared=True)
+    producer = JSONQueue("/shared/leaf", MiddlewareType.PRODUCER, port=broker._port, shared=True)
+
+    producer.push(42)
+
+    assert consumer1.pull() == ("/shared/leaf", 42)
+    assert consumer2.pull() == ("/shared/leaf", 42)
+
+    for queue in (consumer1, consumer2, producer):
+        queue.close()
+
+
+def test_shared_connection_restores_subscriptions(make_broker):
+    broker = make_broker()
+
+    consumer = JSONQueue("/restore", port=broker._port, shared=True)
+    producer = JSONQueue("/restore", MiddlewareType.PRODUCER, port=broker._port)
+    transport = consumer._transport
+
+    broken = transport.socket
+    broken.shutdown(socket.SHUT_RDWR)  # simulate a dropped connection
+
+    for _ in range(50):
+        if transport.socket is not broken:
+            break
+        time.sleep(0.05)
+    time.sleep(0.1)
+
+    producer.push(7)
+    assert consumer.pull() == ("/restore", 7)
+
+    consumer.close()
+
+
+def test_cancel_keeps_the_covering_subscription(make_broker):
+    broker = make_broker()
+    manager = TransportManager(pool_size=1)
+    transport = manager.acquire("localhost", broker._port, 2)
+    outer, inner = SimpleQueue(), SimpleQueue()
+    transport.subscribe("/a", outer)
+    transport.subscribe("/a/b", inner)
+    other = PickleQueue("/a/b", port=broker._port)  # keeps the /a/b subscribers of the broker
+    time.sleep(0.1)
+
+    transport.unsubscribe("/a/b", inner)
+    time.sleep(0.1)
+    JSONQueue("/a/b", MiddlewareType.PRODUCER, port=broker._port).push(1)
+    assert outer.get(timeout=2) == ("/a/b", 1)
+    assert other.pull() == ("/a/b", 1)
+
+    other.close()
+    manager.close_all()
+
+
+def test_close_while_the_broker_is_down(make_broker):
+    broker = make_broker()
+    manager = TransportManager()
+    transport = manager.acquire("localhost", broker._port, 0)
+    transport.send_timeout = 0.2
+
+    broker.canceled = True  # the loop stops, then the listening socket goes away
+    time.sleep(0.3)
+    broker.socket.close()
+    transport.socket.shutdown(socket.SHUT_RDWR)
+    time.sleep(0.2)  # reconnecting, with nobody listening
+
+    with pytest.raises(ConnectionError):
+        transport.send(Protocol.publish("/down", 1))
+    start = time.perf_counter()
+    manager.close_all()
+    transport._thread.join(timeout=2)
+    assert time.perf_counter() - start < 1
+    assert not transport._thread.is_alive()
+
+
+def test_send_leaves_reconnecting_to_the_reader(make_broker):
+    broker = make_broker()
+    manager = TransportManager()
+    transport = manager.acquire("localhost", broker._port, 0)
+    transport.send_timeout = 0.3
+
+    broker.canceled = True
+    time.sleep(0.3)
+    broker.socket.close()
+    transport.socket.shutdown(socket.SHUT_WR)  # only a sender notices the break
+
+    start = time.perf_counter()
+    with pytest.raises(ConnectionError):  # not retrying the connection on this thread
+        transport.send(Protocol.publish("/down", 1))
+    assert time.perf_counter() - start < 1
+    manager.close_all()
+    transport._thread.join(timeout=2)
+    assert not transport._thread.is_alive()
@@ -0,0 +1,43 @@
+"""Test the unix socket listener."""
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.middleware import AsyncJSONQueue, JSONQueue, MiddlewareType, PickleQueue
+
+
+def test_unix_and_tcp_clients(make_broker, tmp_path):
+    path = str(tmp_path / "broker.sock")
+    broker = make_broker(unix_path=path)
+    assert os.path.exists(path)
+
+    unix_consumer = PickleQueue("/unix", host="unix://" + path)
+    tcp_consumer = JSONQueue("/unix", port=broker._port)
+    shared_consumer = JSONQueue("/unix", host="unix://" + path, shared=True)
+    producer = JSONQueue("/unix", MiddlewareType.PRODUCER, host="unix://" + path)
+    time.sleep(0.1)
+
+    producer.push(5)
+
+    assert unix_consumer.pull() == ("/unix", 5)
+    assert tcp_consumer.pull() == ("/unix", 5)
+    assert shared_consumer.pull() == ("/unix", 5)
+
+
+def test_async_unix_client(make_broker, tmp_path):
+    path = str(tmp_path / "broker.sock")
+    make_broker(unix_path=path)
+
+    async def scenario():
+        consumer = await AsyncJSONQueue.connect("/unix/async", host="unix://" + path)
+        await asyncio.sleep(0.1)
+        producer = await AsyncJSONQueue.connect("/unix/async", MiddlewareType.PRODUCER, host="unix://" + path)
+        await producer.push("hello")
+        message = await consumer.pull()
+        await producer.close()
+        await consumer.close()
+        return message
+
+    assert asyncio.run(scenario()) == ("/unix/async", "hello")